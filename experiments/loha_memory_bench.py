@@ -0,0 +1,63 @@
+import time
+
+import torch
+
+from lycoris.loha import HadaWeight, HadaWeightLowMem
+
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+RANK = 8
+STEPS = 10
+# (out, in*k*k) of some SD1.x UNet layers
+SHAPES = {
+    'attn to_q (320)': (320, 320),
+    'attn to_k (640, ctx)': (640, 768),
+    'attn to_out (1280)': (1280, 1280),
+    'ff proj (1280->10240)': (10240, 1280),
+    'ff out (5120->1280)': (1280, 5120),
+    'resnet conv (640 3x3)': (640, 640*9),
+    'resnet conv (1280 3x3)': (1280, 1280*9),
+}
+
+
+def bench(func, out_dim, in_dim):
+    orig = torch.randn(out_dim, in_dim, device=DEVICE)
+    w1a = torch.randn(out_dim, RANK, device=DEVICE, requires_grad=True)
+    w1b = torch.randn(RANK, in_dim, device=DEVICE, requires_grad=True)
+    w2a = torch.randn(out_dim, RANK, device=DEVICE, requires_grad=True)
+    w2b = torch.randn(RANK, in_dim, device=DEVICE, requires_grad=True)
+    scale = torch.tensor(1.0)
+
+    def step():
+        weight = func.apply(orig, w1a, w1b, w2a, w2b, scale)
+        weight.sum().backward()
+
+    step()
+    if DEVICE == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_mem = torch.cuda.memory_allocated()
+
+    t0 = time.time()
+    for _ in range(STEPS):
+        step()
+    if DEVICE == 'cuda':
+        torch.cuda.synchronize()
+    step_time = (time.time() - t0) / STEPS
+
+    # torch cpu allocations are not tracked (tracemalloc can't see them)
+    peak = None
+    if DEVICE == 'cuda':
+        peak = (torch.cuda.max_memory_allocated() - base_mem) / 1024**2
+    return step_time, peak
+
+
+print(f'device: {DEVICE}, rank: {RANK}')
+if DEVICE != 'cuda':
+    print('peak memory is only measured on cuda')
+print(f'{"layer":<25}{"impl":<10}{"step(ms)":>10}{"peak(MiB)":>12}')
+for name, (out_dim, in_dim) in SHAPES.items():
+    for impl, func in (('default', HadaWeight), ('low_mem', HadaWeightLowMem)):
+        step_time, peak = bench(func, out_dim, in_dim)
+        peak = '-' if peak is None else f'{peak:.1f}'
+        print(f'{name:<25}{impl:<10}{step_time*1000:>10.2f}{peak:>12}')
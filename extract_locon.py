@@ -25,11 +25,84 @@ def get_args():
     parser.add_argument(
         "--mode", 
         help=(
-            'extraction mode, can be "fixed", "threshold", "ratio", "percentile". '
-            'If not "fixed", network_dim and conv_dim will be ignored'
+            'extraction mode, can be "fixed", "threshold", "ratio", "percentile", "budget". '
+            'If not "fixed", network_dim and conv_dim will be ignored. '
+            '"budget" choose the rank of every layer to fit --budget or --budget_mb'
         ),
         default='fixed', type=str
     )
+    parser.add_argument(
+        "--budget", help="total number of parameters of the output in budget mode",
+        default=None, type=int
+    )
+    parser.add_argument(
+        "--budget_mb", help="output file size (MB, in --save_dtype) in budget mode",
+        default=None, type=float
+    )
+    parser.add_argument(
+        "--svd_backend", 
+        help=(
+            'svd backend, can be "full", "randomized", "lanczos", "auto". '
+            'The rank is decided from singular values first, then only the needed vectors are computed. '
+            '"auto" use randomized svd when the rank is small relative to the layer size'
+        ),
+        default='auto', type=str
+    )
+    parser.add_argument(
+        "--workers", help="number of layers to extract concurrently",
+        default=1, type=int
+    )
+    parser.add_argument(
+        "--batch_svd", help="extract layers with same shape by one batched svd",
+        default=False, action="store_true"
+    )
+    parser.add_argument(
+        "--streaming", 
+        help="read layers from the checkpoints one by one instead of loading two full models",
+        default=False, action="store_true"
+    )
+    parser.add_argument(
+        "--partial_dir", 
+        help=(
+            "save every extracted layer into this dir and skip layers already in it, "
+            "so a crashed extraction can be resumed. The shards are deleted after the output is saved "
+            "(and the dir too if nothing else is in it)"
+        ),
+        default=None, type=str
+    )
+    parser.add_argument(
+        "--cache_dir", 
+        help=(
+            "cache singular values of every layer in this dir (keyed by the hash of base/db model), "
+            "re-extract the same pair with other mode or rank is then only a slicing operation"
+        ),
+        default=None, type=str
+    )
+    parser.add_argument(
+        "--cache_rank", help="also cache the singular vectors up to this rank",
+        default=0, type=int
+    )
+    parser.add_argument(
+        "--report", help="write per-layer reconstruction error and retained energy to this .json/.csv",
+        default=None, type=str
+    )
+    parser.add_argument(
+        "--use_tucker", 
+        help="extract kxk conv as 1x1 down, kxk mid (rank x rank) and 1x1 up, smaller than a full kxk down",
+        default=False, action="store_true"
+    )
+    parser.add_argument(
+        "--compute_dtype", help='dtype used for svd, can be "fp32", "fp64"',
+        default='fp32', type=str
+    )
+    parser.add_argument(
+        "--save_dtype", help='dtype of the output weights, can be "fp16", "bf16", "fp32"',
+        default='fp16', type=str
+    )
+    parser.add_argument(
+        "--fp64_max_numel", help="layers with at most this many elements are computed in fp64",
+        default=0, type=int
+    )
     parser.add_argument(
         "--safetensors", help='use safetensors to save locon model',
         default=False, action="store_true"
@@ -70,39 +143,92 @@ def get_args():
 ARGS = get_args()
 
 
-from locon.utils import extract_diff
+from locon.utils import (
+    extract_diff, extract_diff_ldm, consolidate_partial,
+    SpectrumCache, spectrum_cache_path, model_pair_id
+)
 from locon.kohya_model_utils import load_models_from_stable_diffusion_checkpoint
 
 import torch
 from safetensors.torch import save_file
 
 
+DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+    'fp32': torch.float32,
+    'fp64': torch.float64,
+}
+
+
 def main():
     args = ARGS
-    base = load_models_from_stable_diffusion_checkpoint(args.is_v2, args.base_model)
-    db = load_models_from_stable_diffusion_checkpoint(args.is_v2, args.db_model)
+    save_dtype = DTYPES[args.save_dtype]
     
     linear_mode_param = {
         'fixed': args.linear_dim,
         'threshold': args.linear_threshold,
         'ratio': args.linear_ratio,
         'percentile': args.linear_percentile,
+        'budget': None,
     }[args.mode]
     conv_mode_param = {
         'fixed': args.conv_dim,
         'threshold': args.conv_threshold,
         'ratio': args.conv_ratio,
         'percentile': args.conv_percentile,
+        'budget': None,
     }[args.mode]
+    budget = args.budget
+    if args.budget_mb is not None:
+        budget = int(args.budget_mb * 1024 * 1024 / (torch.finfo(save_dtype).bits // 8))
     
-    state_dict = extract_diff(
-        base, db,
-        args.mode,
-        linear_mode_param, conv_mode_param,
-        args.device
-    )
+    extract_args = dict(
+        svd_backend = args.svd_backend,
+        workers = args.workers,
+        batch_svd = args.batch_svd,
+        partial_dir = args.partial_dir,
+        budget = budget,
+        report = args.report,
+        dtype = DTYPES[args.compute_dtype],
+        save_dtype = save_dtype,
+        fp64_max_numel = args.fp64_max_numel,
+        use_tucker = args.use_tucker,
+    )
+    pair_id = None
+    if args.partial_dir is not None or args.cache_dir is not None:
+        pair_id = model_pair_id(args.base_model, args.db_model)
+        extract_args['source'] = pair_id
+    if args.cache_dir is not None:
+        extract_args['spectrum_cache'] = SpectrumCache(
+            spectrum_cache_path(args.cache_dir, args.base_model, args.db_model, pair_id),
+            args.cache_rank,
+        )
+    if args.streaming:
+        state_dict = extract_diff_ldm(
+            args.base_model, args.db_model, args.is_v2,
+            args.mode,
+            linear_mode_param, conv_mode_param,
+            args.device,
+            **extract_args
+        )
+    else:
+        base = load_models_from_stable_diffusion_checkpoint(args.is_v2, args.base_model)
+        db = load_models_from_stable_diffusion_checkpoint(args.is_v2, args.db_model)
+        state_dict = extract_diff(
+            base, db,
+            args.mode,
+            linear_mode_param, conv_mode_param,
+            args.device,
+            **extract_args
+        )
     
-    if args.safetensors:
+    if args.partial_dir is not None:
+        # every layer has a shard now, build the output from them and remove the dir
+        lora_names = list(dict.fromkeys(key.split('.', 1)[0] for key in state_dict))
+        del state_dict
+        consolidate_partial(args.partial_dir, args.output_name, lora_names, args.safetensors)
+    elif args.safetensors:
         save_file(state_dict, args.output_name)
     else:
         torch.save(state_dict, args.output_name)
@@ -2,7 +2,9 @@ from lycoris import (
     kohya,
     kohya_model_utils,
     kohya_utils,
+    ldm_utils,
     locon,
     loha,
+    mergeable,
     utils,
 )
\ No newline at end of file
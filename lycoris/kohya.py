@@ -12,6 +12,7 @@ import torch
 from .kohya_utils import *
 from .locon import LoConModule
 from .loha import LohaModule
+from .utils import get_module_index
 
 
 def create_network(multiplier, network_dim, network_alpha, vae, text_encoder, unet, **kwargs):
@@ -21,6 +22,12 @@ def create_network(multiplier, network_dim, network_alpha, vae, text_encoder, un
     conv_alpha = float(kwargs.get('conv_alpha', network_alpha))
     dropout = float(kwargs.get('dropout', 0.))
     algo = kwargs.get('algo', 'lora')
+    forward_mode = kwargs.get('forward_mode', 'weight')
+    auto_per_shape = str(kwargs.get('auto_per_shape', True)).lower() in {'true', '1'}
+    flops_per_byte = float(kwargs.get('flops_per_byte', 32))
+    low_mem = str(kwargs.get('low_mem', False)).lower() in {'true', '1'}
+    use_tucker = str(kwargs.get('use_tucker', False)).lower() in {'true', '1'}
+    assert not use_tucker or algo == 'lora', 'use_tucker is only supported by lora (LoCon)'
     network_module = {
         'lora': LoConModule,
         'loha': LohaModule,
@@ -33,32 +40,67 @@ def create_network(multiplier, network_dim, network_alpha, vae, text_encoder, un
         lora_dim=network_dim, conv_lora_dim=conv_dim, 
         alpha=network_alpha, conv_alpha=conv_alpha,
         dropout=dropout,
-        network_module=network_module
+        network_module=network_module,
+        use_tucker=use_tucker,
     )
+    network.set_forward_mode(forward_mode, auto_per_shape, flops_per_byte)
+    if low_mem:
+        network.enable_low_mem()
     
     return network
 
 
+def load_weights_lazy(file):
+    '''
+    Open a LyCORIS model without reading the weights.
+    .safetensors: only the header is read, every tensor is loaded when it is asked for.
+    .pt/.ckpt: loaded with mmap if torch support it.
+    '''
+    from .ldm_utils import LazyCheckpoint
+    return LazyCheckpoint(file)
+
+
+def get_modules_info(weights_sd):
+    '''
+    Detect rank, alpha and algo of every module from the (lazy) state dict.
+    Only shapes and alpha values are read.
+    algo: 'lora', 'tucker' (lora with lora_mid) or 'loha'
+    Return (modules_dim, modules_alpha, modules_algo), all {lora_name: value}
+    '''
+    modules_dim = {}
+    modules_alpha = {}
+    modules_algo = {}
+    for key in weights_sd.keys():
+        lora_name, _, param = key.partition('.')
+        if param == 'alpha':
+            modules_alpha[lora_name] = float(weights_sd.get(key))
+        elif param == 'lora_down.weight':
+            modules_dim[lora_name] = weights_sd.shape(key)[0]
+            modules_algo.setdefault(lora_name, 'lora')
+        elif param == 'lora_mid.weight':
+            modules_algo[lora_name] = 'tucker'
+        elif param == 'hada_w1_b':
+            modules_dim[lora_name] = weights_sd.shape(key)[0]
+            modules_algo[lora_name] = 'loha'
+    
+    for lora_name, dim in modules_dim.items():
+        # no alpha means no scaling
+        modules_alpha.setdefault(lora_name, dim)
+    return modules_dim, modules_alpha, modules_algo
+
+
 def create_network_from_weights(multiplier, file, vae, text_encoder, unet, **kwargs):
-    if os.path.splitext(file)[1] == '.safetensors':
-        from safetensors.torch import load_file, safe_open
-        weights_sd = load_file(file)
-    else:
-        weights_sd = torch.load(file, map_location='cpu')
-
-    # get dim (rank)
-    network_alpha = None
-    network_dim = None
-    for key, value in weights_sd.items():
-        if network_alpha is None and 'alpha' in key:
-            network_alpha = value
-        if network_dim is None and 'lora_down' in key and len(value.size()) == 2:
-            network_dim = value.size()[0]
-
-    if network_alpha is None:
-        network_alpha = network_dim
-
-    network = LoRANetwork(text_encoder, unet, multiplier=multiplier, lora_dim=network_dim, alpha=network_alpha)
+    weights_sd = load_weights_lazy(file)
+    modules_dim, modules_alpha, modules_algo = get_modules_info(weights_sd)
+
+    network = LoRANetwork(
+        text_encoder, unet, 
+        multiplier=multiplier, 
+        forward_mode=kwargs.get('forward_mode', 'weight'),
+        modules_dim=modules_dim, 
+        modules_alpha=modules_alpha, 
+        modules_algo=modules_algo,
+    )
     network.weights_sd = weights_sd
     return network
 
@@ -86,7 +128,15 @@ class LoRANetwork(torch.nn.Module):
         lora_dim=4, conv_lora_dim=4, 
         alpha=1, conv_alpha=1,
         dropout = 0, network_module = LoConModule,
+        forward_mode = 'weight',
+        use_tucker = False,
+        modules_dim = None, modules_alpha = None, modules_algo = None,
     ) -> None:
+        '''
+        modules_dim/modules_alpha/modules_algo: {lora_name: value} (see get_modules_info)
+        If given, only the modules in modules_dim are created, each one with its own
+        rank, alpha and algo. lora_dim, alpha and network_module are ignored.
+        '''
         super().__init__()
         self.multiplier = multiplier
         self.lora_dim = lora_dim
@@ -105,37 +155,51 @@ class LoRANetwork(torch.nn.Module):
             print(f'Use Dropout value: {dropout}')
         self.dropout = dropout
         
+        self.use_tucker = use_tucker
+        if use_tucker:
+            print('Use tucker decomposition (1x1 down, kxk mid, 1x1 up) for conv layer')
+        conv_kwargs = {'use_tucker': True} if use_tucker else {}
+        
+        if modules_dim is not None:
+            print(f'Use per module rank/alpha/algo for {len(modules_dim)} modules')
+            modules_algo = modules_algo or {}
+        
+        def create_module_from_info(lora_name, child_module):
+            algo = modules_algo.get(lora_name, 'lora')
+            module = LohaModule if algo == 'loha' else LoConModule
+            kwargs = {'use_tucker': True} if algo == 'tucker' else {}
+            return module(
+                lora_name, child_module, self.multiplier, 
+                modules_dim[lora_name], modules_alpha[lora_name], self.dropout,
+                **kwargs
+            )
+        
         # create module instances
         def create_modules(prefix, root_module: torch.nn.Module, target_replace_modules) -> List[network_module]:
             print('Create LoCon Module')
             loras = []
-            for name, module in root_module.named_modules():
-                if module.__class__.__name__ in target_replace_modules:
-                    for child_name, child_module in module.named_modules():
-                        lora_name = prefix + '.' + name + '.' + child_name
-                        lora_name = lora_name.replace('.', '_')
-                        if child_module.__class__.__name__ == 'Linear' and lora_dim>0:
-                            lora = network_module(
-                                lora_name, child_module, self.multiplier, 
-                                self.lora_dim, self.alpha, self.dropout
-                            )
-                        elif child_module.__class__.__name__ == 'Conv2d':
-                            k_size, *_ = child_module.kernel_size
-                            if k_size==1 and lora_dim>0:
-                                lora = network_module(
-                                    lora_name, child_module, self.multiplier, 
-                                    self.lora_dim, self.alpha, self.dropout
-                                )
-                            elif conv_lora_dim>0:
-                                lora = network_module(
-                                    lora_name, child_module, self.multiplier, 
-                                    self.conv_lora_dim, self.conv_alpha, self.dropout
-                                )
-                            else:
-                                continue
-                        else:
-                            continue
-                        loras.append(lora)
+            index = get_module_index(prefix, root_module, target_replace_modules)
+            for lora_name, (child_module, shape, layer) in index.items():
+                if modules_dim is not None:
+                    if lora_name not in modules_dim:
+                        continue
+                    lora = create_module_from_info(lora_name, child_module)
+                elif layer == 'Linear' or shape[2:] == (1, 1):
+                    if lora_dim <= 0:
+                        continue
+                    lora = network_module(
+                        lora_name, child_module, self.multiplier, 
+                        self.lora_dim, self.alpha, self.dropout
+                    )
+                elif conv_lora_dim > 0:
+                    lora = network_module(
+                        lora_name, child_module, self.multiplier, 
+                        self.conv_lora_dim, self.conv_alpha, self.dropout,
+                        **conv_kwargs
+                    )
+                else:
+                    continue
+                loras.append(lora)
             return loras
 
         self.text_encoder_loras = create_modules(
@@ -155,18 +219,53 @@ class LoRANetwork(torch.nn.Module):
         for lora in self.text_encoder_loras + self.unet_loras:
             assert lora.lora_name not in names, f"duplicated lora name: {lora.lora_name}"
             names.add(lora.lora_name)
+        
+        self.set_forward_mode(forward_mode)
 
     def set_multiplier(self, multiplier):
         self.multiplier = multiplier
         for lora in self.text_encoder_loras + self.unet_loras:
             lora.multiplier = self.multiplier
+            lora.clear_weight_cache()
+            
+    def set_forward_mode(self, forward_mode, auto_per_shape=True, flops_per_byte=32):
+        '''
+        weight: merge delta into org weight then run org op (default)
+        lora: run org op and low rank branch separately
+        auto: estimate FLOPs and bytes of both path and choose the cheaper one,
+              re-decide for every new input shape if auto_per_shape.
+              flops_per_byte is the machine balance used to weight the bytes.
+        Only LoCon support low rank branch, other modules always use weight.
+        '''
+        assert forward_mode in {'weight', 'lora', 'auto'}, f"unknown forward mode: {forward_mode}"
+        if forward_mode != 'weight':
+            print(f'Use forward mode: {forward_mode}')
+        self.forward_mode = forward_mode
+        for lora in self.text_encoder_loras + self.unet_loras:
+            if isinstance(lora, LoConModule):
+                lora.forward_mode = forward_mode
+                lora.auto_per_shape = auto_per_shape
+                lora.flops_per_byte = flops_per_byte
+                lora.forward_mode_cache.clear()
+
+    def forward_mode_report(self):
+        '''
+        Which forward path each module has chosen.
+        {lora_name: {input_shape(or None): mode}}
+        Modules in auto mode only have entries after they have seen an input.
+        '''
+        report = {}
+        for lora in self.text_encoder_loras + self.unet_loras:
+            mode = getattr(lora, 'forward_mode', 'weight')
+            if mode == 'auto':
+                report[lora.lora_name] = dict(lora.forward_mode_cache)
+            else:
+                report[lora.lora_name] = {None: mode}
+        return report
             
     def load_weights(self, file):
-        if os.path.splitext(file)[1] == '.safetensors':
-            from safetensors.torch import load_file, safe_open
-            self.weights_sd = load_file(file)
-        else:
-            self.weights_sd = torch.load(file, map_location='cpu')
+        # tensors are materialized module by module in apply_to
+        self.weights_sd = load_weights_lazy(file)
 
     def apply_to(self, text_encoder, unet, apply_text_encoder=None, apply_unet=None):
         if self.weights_sd:
@@ -205,11 +304,66 @@ class LoRANetwork(torch.nn.Module):
 
         if self.weights_sd:
             # if some weights are not in state dict, it is ok because initial LoRA does nothing (lora_up is initialized by zeros)
-            info = self.load_state_dict(self.weights_sd, False)
-            print(f"weights are loaded: {info}")
+            # load module by module, so only the weights of one module are materialized at a time
+            module_keys = {}
+            for key in self.weights_sd.keys():
+                module_keys.setdefault(key.split('.', 1)[0], []).append(key)
+            missing_keys, unexpected_keys = [], []
+            for lora in self.text_encoder_loras + self.unet_loras:
+                prefix = lora.lora_name + '.'
+                state_dict = {
+                    key[len(prefix):]: self.weights_sd[key]
+                    for key in module_keys.pop(lora.lora_name, [])
+                }
+                info = lora.load_state_dict(state_dict, False)
+                missing_keys += [prefix + key for key in info.missing_keys]
+                unexpected_keys += [prefix + key for key in info.unexpected_keys]
+                del state_dict
+            unexpected_keys += [key for keys in module_keys.values() for key in keys]
+            print(f"weights are loaded: missing_keys={missing_keys}, unexpected_keys={unexpected_keys}")
+
+    def enable_weight_cache(self):
+        '''
+        Inference mode: every module merge its weight only once and reuse it.
+        The cache is rebuilt when multiplier or any related weight is changed in-place.
+        (Changes through .data are not tracked, call disable/enable again for that.)
+        '''
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.cache_weight = True
+
+    def disable_weight_cache(self):
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.cache_weight = False
+            lora.clear_weight_cache()
+
+    def enable_low_mem(self):
+        '''
+        LoHa: use the weight function which keep only one full size buffer alive.
+        '''
+        print('Use low memory LoHa weight function')
+        for lora in self.text_encoder_loras + self.unet_loras:
+            if isinstance(lora, LohaModule):
+                lora.low_mem = True
+
+    def merge_to(self, multiplier=None, backup=False):
+        '''
+        Add every delta into its org weight and restore org forward,
+        so generation runs at the speed of the base model.
+        Call after apply_to(). Use unmerge() to go back (e.g. to load another adapter).
+        backup: keep a cpu copy of every touched weight for exact unmerge,
+                otherwise the same delta is subtracted (may drift slightly in fp16).
+        '''
+        if multiplier is None:
+            multiplier = self.multiplier
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.merge_to(multiplier, backup)
+
+    def unmerge(self):
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.unmerge()
 
     def enable_gradient_checkpointing(self):
-        # not supported
+        # merged weight of LoCon/LoHa is recomputed in backward instead of being stored
         def make_ckpt(module):
             if isinstance(module, torch.nn.Module):
                 module.grad_ckpt = True
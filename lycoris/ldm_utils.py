@@ -0,0 +1,159 @@
+'''
+Work on original SD (LDM) checkpoints without building diffusers models.
+'''
+
+import torch
+from safetensors import safe_open
+
+from .utils import read_safetensors_header, SAFETENSORS_DTYPES
+from .kohya_model_utils import (
+    is_safetensors,
+    create_unet_diffusers_config,
+    convert_ldm_unet_checkpoint,
+    convert_unet_state_dict_to_sd,
+    convert_ldm_clip_checkpoint_v1,
+    convert_ldm_clip_checkpoint_v2,
+)
+
+
+LORA_PREFIX_UNET = 'lora_unet'
+LORA_PREFIX_TEXT_ENCODER = 'lora_te'
+# diffusers module path of UNET/TEXT_ENCODER_TARGET_REPLACE_MODULE
+UNET_TARGET_PATHS = ('.attentions.', '.resnets.', '.downsamplers.', '.upsamplers.')
+TEXT_ENCODER_TARGET_PATHS = ('.self_attn.', '.mlp.')
+UNET_KEY_PREFIX = 'model.diffusion_model.'
+TEXT_ENCODER_KEY_PREFIX = 'cond_stage_model.'
+
+# same as load_checkpoint_with_text_encoder_conversion
+TEXT_ENCODER_KEY_REPLACEMENTS = [
+    ('cond_stage_model.transformer.embeddings.', 'cond_stage_model.transformer.text_model.embeddings.'),
+    ('cond_stage_model.transformer.encoder.', 'cond_stage_model.transformer.text_model.encoder.'),
+    ('cond_stage_model.transformer.final_layer_norm.', 'cond_stage_model.transformer.text_model.final_layer_norm.')
+]
+
+
+class LazyCheckpoint:
+    '''
+    Read-only view of a checkpoint which only load the tensors you ask for.
+    .safetensors is memory mapped by safe_open,
+    .ckpt/.pt is loaded with mmap when torch support it.
+    Text encoder keys are normalized as load_checkpoint_with_text_encoder_conversion.
+    '''
+    def __init__(self, path):
+        self.path = path
+        if is_safetensors(path):
+            self.file = safe_open(path, framework='pt', device='cpu')
+            self.header = read_safetensors_header(path)
+            self.state_dict = None
+            raw_keys = list(self.file.keys())
+        else:
+            self.file = None
+            try:
+                checkpoint = torch.load(path, map_location='cpu', mmap=True)
+            except (TypeError, RuntimeError):
+                # old torch or old (non zipfile) checkpoint
+                checkpoint = torch.load(path, map_location='cpu')
+            self.state_dict = checkpoint.get('state_dict', checkpoint)
+            raw_keys = [k for k, v in self.state_dict.items() if isinstance(v, torch.Tensor)]
+
+        self.raw_keys = {}
+        for key in raw_keys:
+            new_key = key
+            for rep_from, rep_to in TEXT_ENCODER_KEY_REPLACEMENTS:
+                if key.startswith(rep_from):
+                    new_key = rep_to + key[len(rep_from):]
+            self.raw_keys[new_key] = key
+
+    def keys(self):
+        return self.raw_keys.keys()
+
+    def __contains__(self, key):
+        return key in self.raw_keys
+
+    def __len__(self):
+        return len(self.raw_keys)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def shape(self, key):
+        if self.file is not None:
+            return tuple(self.file.get_slice(self.raw_keys[key]).get_shape())
+        return tuple(self.state_dict[self.raw_keys[key]].shape)
+
+    def dtype(self, key):
+        if self.file is not None:
+            dtype = self.header[self.raw_keys[key]]['dtype']
+            return next(k for k, v in SAFETENSORS_DTYPES.items() if v == dtype)
+        return self.state_dict[self.raw_keys[key]].dtype
+
+    def get(self, key):
+        if self.file is not None:
+            return self.file.get_tensor(self.raw_keys[key])
+        return self.state_dict[self.raw_keys[key]]
+
+    def metadata(self):
+        if self.file is not None:
+            return self.file.metadata()
+        return None
+
+
+def lora_name_of(prefix, hf_key, target_paths, value):
+    if not hf_key.endswith('.weight') or value.ndim not in {2, 4}:
+        return None
+    module_path = '.' + hf_key[:-len('.weight')]
+    if not any(path in module_path for path in target_paths):
+        return None
+    return prefix + module_path.replace('.', '_')
+
+
+def make_lora_key_map(v2, checkpoint: LazyCheckpoint):
+    '''
+    {lora_name: (ldm_key, chunk, shape)} for every layer LoRANetwork can be applied to.
+    chunk: index in the fused qkv weight of SD2 text encoder, or None
+    shape: weight shape in the diffusers model (use it to reshape the ldm weight)
+    Keys are converted with meta tensors, no weight is loaded.
+    '''
+    meta = {
+        key: torch.empty(checkpoint.shape(key), device='meta')
+        for key in checkpoint.keys()
+    }
+    key_map = {}
+
+    # text encoder: convert key by key to know where every weight come from
+    for key, value in meta.items():
+        if not key.startswith(TEXT_ENCODER_KEY_PREFIX):
+            continue
+        if v2:
+            converted = convert_ldm_clip_checkpoint_v2({key: value}, 77)
+        else:
+            converted = convert_ldm_clip_checkpoint_v1({key: value})
+        for hf_key, hf_value in converted.items():
+            lora_name = lora_name_of(LORA_PREFIX_TEXT_ENCODER, hf_key, TEXT_ENCODER_TARGET_PATHS, hf_value)
+            if lora_name is None:
+                continue
+            chunk = None
+            if '.attn.in_proj_' in key:
+                chunk = ['q_proj', 'k_proj', 'v_proj'].index(hf_key.split('.')[-2])
+            key_map[lora_name] = (key, chunk, tuple(hf_value.shape))
+
+    # unet: convert all keys, then convert back the diffusers keys to know their source
+    unet = convert_ldm_unet_checkpoint(v2, dict(meta), create_unet_diffusers_config(v2))
+    for sd_key, hf_key in convert_unet_state_dict_to_sd(False, {k: k for k in unet}).items():
+        lora_name = lora_name_of(LORA_PREFIX_UNET, hf_key, UNET_TARGET_PATHS, unet[hf_key])
+        if lora_name is None:
+            continue
+        key_map[lora_name] = (UNET_KEY_PREFIX + sd_key, None, tuple(unet[hf_key].shape))
+
+    return key_map
+
+
+def load_lora_weight(checkpoint: LazyCheckpoint, entry):
+    '''
+    Load the weight of one entry of make_lora_key_map in diffusers shape.
+    '''
+    key, chunk, shape = entry
+    weight = checkpoint.get(key)
+    if chunk is not None:
+        weight = torch.chunk(weight, 3)[chunk]
+    return weight.reshape(shape)
@@ -3,15 +3,25 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
+from .mergeable import MergeableMixin
 
-class LoConModule(nn.Module):
+
+class LoConModule(MergeableMixin, nn.Module):
     """
     modifed from kohya-ss/sd-scripts/networks/lora:LoRAModule
     """
 
-    def __init__(self, lora_name, org_module: nn.Module, multiplier=1.0, lora_dim=4, alpha=1, dropout=0.):
-        """ if alpha == 0 or None, alpha is rank (no scaling). """
+    def __init__(
+        self, lora_name, org_module: nn.Module, 
+        multiplier=1.0, lora_dim=4, alpha=1, dropout=0., use_tucker=False
+    ):
+        """ 
+        if alpha == 0 or None, alpha is rank (no scaling). 
+        use_tucker: for k x k conv, use 1x1 down -> k x k mid (rank -> rank) -> 1x1 up
+                    instead of a full k x k down kernel.
+        """
         super().__init__()
         self.lora_name = lora_name
         self.lora_dim = lora_dim
@@ -23,7 +33,12 @@ class LoConModule(nn.Module):
             stride = org_module.stride
             padding = org_module.padding
             out_dim = org_module.out_channels
-            self.lora_down = nn.Conv2d(in_dim, lora_dim, k_size, stride, padding, bias=False)
+            if use_tucker and tuple(k_size) != (1, 1):
+                self.lora_down = nn.Conv2d(in_dim, lora_dim, (1, 1), bias=False)
+                self.lora_mid = nn.Conv2d(lora_dim, lora_dim, k_size, stride, padding, bias=False)
+            else:
+                self.lora_down = nn.Conv2d(in_dim, lora_dim, k_size, stride, padding, bias=False)
+                self.lora_mid = None
             self.lora_up = nn.Conv2d(lora_dim, out_dim, (1, 1), bias=False)
             self.op = F.conv2d
             self.extra_args = {
@@ -34,6 +49,7 @@ class LoConModule(nn.Module):
             in_dim = org_module.in_features
             out_dim = org_module.out_features
             self.lora_down = nn.Linear(in_dim, lora_dim, bias=False)
+            self.lora_mid = None
             self.lora_up = nn.Linear(lora_dim, out_dim, bias=False)
             self.op = F.linear
             self.extra_args = {}
@@ -52,20 +68,113 @@ class LoConModule(nn.Module):
 
         # same as microsoft's
         torch.nn.init.kaiming_uniform_(self.lora_down.weight, a=math.sqrt(5))
+        if self.lora_mid is not None:
+            torch.nn.init.kaiming_uniform_(self.lora_mid.weight, a=math.sqrt(5))
         torch.nn.init.zeros_(self.lora_up.weight)
 
         self.multiplier = multiplier
         self.org_module = [org_module]
+        # 'weight': merge delta into weight then run op
+        # 'lora': run org op and low rank branch separately
+        # 'auto': pick the cheaper one for each input
+        self.forward_mode = 'weight'
+        self.forward_mode_cache = {}
+        self.auto_per_shape = True
+        self.flops_per_byte = 32
+        self.grad_ckpt = False
+        self.init_merge_state()
 
     def apply_to(self):
+        self.org_forward = self.org_module[0].forward
         self.org_module[0].forward = self.forward
 
     def make_weight(self):
         wa = self.lora_up.weight
         wb = self.lora_down.weight
+        if self.lora_mid is not None:
+            # up[o, i] * mid[i, j, h, w] * down[j, k] -> [o, k, h, w]
+            return torch.einsum(
+                'ij...,oi,jk->ok...', 
+                self.lora_mid.weight, wa.view(wa.size(0), -1), wb.view(wb.size(0), -1)
+            )
         return (wa.view(wa.size(0), -1) @ wb.view(wb.size(0), -1)).view(self.shape)
 
-    def forward(self, x):
+    def delta_weight(self):
+        return self.make_weight()
+
+    def weight_params(self):
+        params = (self.lora_up.weight, self.lora_down.weight)
+        if self.lora_mid is not None:
+            params += (self.lora_mid.weight,)
+        return params
+
+    def forward_cost(self, input_shape):
+        """
+        Estimate (FLOPs, bytes) of each forward path for given input shape.
+        Both path need the cost of org op, so only the extra part is counted.
+        """
+        out_dim, *rest = self.shape
+        fan_in = math.prod(rest)
+        rank = self.lora_dim
+        if self.op is F.conv2d:
+            batch, _, h, w = input_shape
+            k_h, k_w = rest[1:]
+            s_h, s_w = self.extra_args['stride']
+            p_h, p_w = self.extra_args['padding']
+            tokens = batch * ((h + 2*p_h - k_h)//s_h + 1) * ((w + 2*p_w - k_w)//s_w + 1)
+        else:
+            tokens = math.prod(input_shape[:-1])
+        in_numel = math.prod(input_shape)
+        elem_size = self.lora_down.weight.element_size()
+        
+        if self.lora_mid is not None:
+            in_dim, k_h, k_w = rest
+            in_tokens = batch * h * w
+            params = rank*(in_dim + out_dim) + rank*rank*k_h*k_w
+            # (mid @ down) then up + scale + add to org weight
+            weight_flops = 2*rank*fan_in*(rank + out_dim) + 2*out_dim*fan_in
+            weight_bytes = (params + 2*rank*fan_in + 4*out_dim*fan_in) * elem_size
+            # 1x1 down + k x k mid + 1x1 up + scale + add to org output
+            lora_flops = (
+                2*in_tokens*in_dim*rank + 2*tokens*rank*rank*k_h*k_w 
+                + 2*tokens*rank*out_dim + 2*tokens*out_dim
+            )
+            lora_bytes = (
+                in_numel + params + 2*in_tokens*rank + 2*tokens*rank + 4*tokens*out_dim
+            ) * elem_size
+            return {
+                'weight': (weight_flops, weight_bytes),
+                'lora': (lora_flops, lora_bytes),
+            }
+        
+        # make_weight + scale + add to org weight
+        weight_flops = 2*out_dim*fan_in*rank + 2*out_dim*fan_in
+        weight_bytes = (rank*(out_dim+fan_in) + 4*out_dim*fan_in) * elem_size
+        # down + up + scale + add to org output
+        lora_flops = 2*tokens*rank*(fan_in+out_dim) + 2*tokens*out_dim
+        lora_bytes = (in_numel + rank*(fan_in+out_dim) + 2*tokens*rank + 4*tokens*out_dim) * elem_size
+        return {
+            'weight': (weight_flops, weight_bytes),
+            'lora': (lora_flops, lora_bytes),
+        }
+
+    def select_forward_mode(self, x):
+        """
+        Roofline style choice: a path costs max(FLOPs, bytes * flops_per_byte).
+        Decision is cached by input shape (or only made once if not auto_per_shape).
+        """
+        key = tuple(x.shape) if self.auto_per_shape else None
+        mode = self.forward_mode_cache.get(key, None)
+        if mode is None:
+            costs = self.forward_cost(tuple(x.shape))
+            mode = min(
+                costs, 
+                key=lambda k: max(costs[k][0], costs[k][1]*self.flops_per_byte)
+            )
+            self.forward_mode_cache[key] = mode
+        return mode
+
+    def _forward_weight(self, x):
         bias = None if self.org_module[0].bias is None else self.org_module[0].bias.data
         return self.op(
             x,
@@ -73,4 +182,35 @@ class LoConModule(nn.Module):
              + self.dropout(self.make_weight()) * self.multiplier * self.scale),
             bias,
             **self.extra_args,
-        )
\ No newline at end of file
+        )
+
+    def _forward_lora(self, x):
+        x_down = self.lora_down(x)
+        if self.lora_mid is not None:
+            x_down = self.lora_mid(x_down)
+        return (
+            self.org_forward(x)
+            + self.lora_up(self.dropout(x_down)) * self.multiplier * self.scale
+        )
+
+    def _forward_cached(self, x):
+        bias = None if self.org_module[0].bias is None else self.org_module[0].bias.data
+        return self.op(x, self.get_merged_weight(), bias, **self.extra_args)
+
+    def forward(self, x):
+        if self.cache_weight:
+            return self._forward_cached(x)
+        mode = self.forward_mode
+        if mode == 'auto':
+            if self.training and isinstance(self.dropout, nn.Dropout):
+                # the two paths drop different things (weight vs activation),
+                # keep the original weight dropout instead of switching per shape
+                mode = 'weight'
+            else:
+                mode = self.select_forward_mode(x)
+        if mode == 'lora':
+            return self._forward_lora(x)
+        if self.grad_ckpt and self.training and torch.is_grad_enabled():
+            # don't keep the full size merged weight for backward, rebuild it from lora_up/down
+            return checkpoint(self._forward_weight, x, use_reentrant=False)
+        return self._forward_weight(x)
\ No newline at end of file
@@ -3,6 +3,9 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from .mergeable import MergeableMixin
 
 
 class HadaWeight(torch.autograd.Function):
@@ -27,11 +30,51 @@ class HadaWeight(torch.autograd.Function):
         return grad_out, grad_w1a, grad_w1b, grad_w2a, grad_w2b, None
 
 
-def make_weight(orig_weight, w1a, w1b, w2a, w2b, scale):
+class HadaWeightLowMem(torch.autograd.Function):
+    """
+    Same result as HadaWeight, but only one full size buffer is alive at a time:
+    forward build the 2nd product chunk by chunk into the 1st one,
+    backward reuse one buffer for both products.
+    """
+    @staticmethod
+    def forward(ctx, orig_weight, w1a, w1b, w2a, w2b, scale=torch.tensor(1), chunks=8):
+        ctx.save_for_backward(w1a, w1b, w2a, w2b, scale)
+        diff_weight = w1a @ w1b
+        rows = max(1, math.ceil(diff_weight.size(0) / chunks))
+        for i in range(0, diff_weight.size(0), rows):
+            diff_weight[i:i+rows].mul_(w2a[i:i+rows] @ w2b)
+        diff_weight.mul_(scale)
+        
+        orig_weight = orig_weight.reshape(diff_weight.shape)
+        if diff_weight.dtype == torch.result_type(orig_weight, diff_weight):
+            return diff_weight.add_(orig_weight)
+        return orig_weight + diff_weight
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        (w1a, w1b, w2a, w2b, scale) = ctx.saved_tensors
+        temp = w2a @ w2b
+        temp.mul_(grad_out).mul_(scale)
+        grad_w1a = temp @ w1b.T
+        grad_w1b = w1a.T @ temp
+
+        torch.mm(w1a, w1b, out=temp)
+        temp.mul_(grad_out).mul_(scale)
+        grad_w2a = temp @ w2b.T
+        grad_w2b = w2a.T @ temp
+        
+        del temp
+        grad_orig = grad_out if ctx.needs_input_grad[0] else None
+        return grad_orig, grad_w1a, grad_w1b, grad_w2a, grad_w2b, None, None
+
+
+def make_weight(orig_weight, w1a, w1b, w2a, w2b, scale, low_mem=False):
+    if low_mem:
+        return HadaWeightLowMem.apply(orig_weight, w1a, w1b, w2a, w2b, scale)
     return HadaWeight.apply(orig_weight, w1a, w1b, w2a, w2b, scale)
 
 
-class LohaModule(nn.Module):
+class LohaModule(MergeableMixin, nn.Module):
     """
     Hadamard product Implementaion for Low Rank Adaptation
     """
@@ -88,8 +131,11 @@ class LohaModule(nn.Module):
         self.multiplier = multiplier
         self.org_module = [org_module] # remove in applying
         self.grad_ckpt = False
+        self.low_mem = False
+        self.init_merge_state()
 
     def apply_to(self):
+        self.org_forward = self.org_module[0].forward
         self.org_module[0].forward = self.forward
 
     def get_weight(self):
@@ -97,14 +143,30 @@ class LohaModule(nn.Module):
         d_weight *= self.hada_w2_a @ self.hada_w2_b
         return (d_weight).reshape(self.shape)
 
-    @torch.enable_grad()
+    def delta_weight(self):
+        return self.get_weight()
+
+    def weight_params(self):
+        return (self.hada_w1_a, self.hada_w1_b, self.hada_w2_a, self.hada_w2_b)
+
     def forward(self, x):
+        if self.cache_weight:
+            bias = None if self.org_module[0].bias is None else self.org_module[0].bias.data
+            return self.op(x, self.get_merged_weight(), bias, **self.extra_args)
+        if self.grad_ckpt and self.training and torch.is_grad_enabled():
+            # don't keep the full size merged weight for backward, rebuild it from hada weights
+            return checkpoint(self._forward, x, use_reentrant=False)
+        return self._forward(x)
+
+    @torch.enable_grad()
+    def _forward(self, x):
         # print(torch.mean(torch.abs(self.orig_w1a.to(x.device) - self.hada_w1_a)), end='\r')
         weight = make_weight(
             self.org_module[0].weight.data, 
             self.hada_w1_a, self.hada_w1_b,
             self.hada_w2_a, self.hada_w2_b,
             scale = torch.tensor(self.scale*self.multiplier),
+            low_mem = self.low_mem,
         )
         
         bias = None if self.org_module[0].bias is None else self.org_module[0].bias.data
@@ -0,0 +1,81 @@
+import torch
+
+
+class MergeableMixin:
+    """
+    Merged weight cache and in-place merge/unmerge shared by LoCon and LoHa.
+    Modules provide:
+      delta_weight(): delta without multiplier/scale, in org weight shape
+      weight_params(): params the delta depends on (for the cache key)
+    and need org_module, org_forward (set in apply_to), multiplier and scale.
+    """
+
+    def init_merge_state(self):
+        # merged weight cache for inference
+        self.cache_weight = False
+        self.cached_weight = None
+        self.cached_key = None
+        # in-place merge state
+        self.merged_multiplier = None
+        self.org_weight_backup = None
+
+    def delta_weight(self):
+        raise NotImplementedError
+
+    def weight_params(self):
+        raise NotImplementedError
+
+    def weight_cache_key(self):
+        # in-place update (optimizer step, load_state_dict, ...) bump _version
+        params = (self.org_module[0].weight,) + tuple(self.weight_params())
+        return (self.multiplier,) + tuple((p._version, p.data_ptr(), p.device) for p in params)
+
+    def clear_weight_cache(self):
+        self.cached_weight = None
+        self.cached_key = None
+
+    @torch.no_grad()
+    def merge_to(self, multiplier=1.0, backup=False):
+        """
+        Add delta into org weight and restore org forward.
+        Need apply_to() first.
+        If backup, keep a cpu copy of org weight for exact unmerge.
+        """
+        if self.merged_multiplier is not None:
+            self.unmerge()
+        org_weight = self.org_module[0].weight
+        if backup:
+            self.org_weight_backup = org_weight.detach().to('cpu', copy=True)
+        delta = self.delta_weight() * multiplier * self.scale
+        org_weight.add_(delta.to(org_weight.dtype))
+        del delta
+        self.merged_multiplier = multiplier
+        self.clear_weight_cache()
+        self.org_module[0].forward = self.org_forward
+
+    @torch.no_grad()
+    def unmerge(self):
+        if self.merged_multiplier is None:
+            return
+        org_weight = self.org_module[0].weight
+        if self.org_weight_backup is not None:
+            org_weight.copy_(self.org_weight_backup)
+            self.org_weight_backup = None
+        else:
+            delta = self.delta_weight() * self.merged_multiplier * self.scale
+            org_weight.sub_(delta.to(org_weight.dtype))
+            del delta
+        self.merged_multiplier = None
+        self.org_module[0].forward = self.forward
+
+    @torch.no_grad()
+    def get_merged_weight(self):
+        key = self.weight_cache_key()
+        if self.cached_weight is None or self.cached_key != key:
+            self.cached_weight = None
+            org_weight = self.org_module[0].weight.data
+            self.cached_weight = (
+                org_weight + self.delta_weight() * self.multiplier * self.scale
+            ).to(org_weight.dtype)
+            self.cached_key = key
+        return self.cached_weight
@@ -1,22 +1,116 @@
+import csv
+import hashlib
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import NamedTuple
+from weakref import WeakKeyDictionary
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 import torch.linalg as linalg
 
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 
+from .kohya_utils import addnet_hash_safetensors
 
-def extract_conv(
-    weight: nn.Parameter|torch.Tensor,
-    mode = 'fixed',
-    mode_param = 0,
-    device = 'cpu',
-) -> tuple[nn.Parameter, nn.Parameter]:
-    out_ch, in_ch, kernel_size, _ = weight.shape
+
+UNET_TARGET_REPLACE_MODULE = [
+    "Transformer2DModel", 
+    "Attention", 
+    "ResnetBlock2D", 
+    "Downsample2D", 
+    "Upsample2D"
+]
+TEXT_ENCODER_TARGET_REPLACE_MODULE = ["CLIPAttention", "CLIPMLP"]
+LORA_PREFIX_UNET = 'lora_unet'
+LORA_PREFIX_TEXT_ENCODER = 'lora_te'
+
+
+SVD_BACKENDS = {'full', 'randomized', 'lanczos', 'auto'}
+
+
+def svd_residual(weight, U, S, Vh):
+    """
+    Relative residual of approximated singular triplets:
+    max(|W V - U S|, |W^T U - V S|) / |S|
+    """
+    s_norm = torch.linalg.norm(S).clamp_min(1e-12)
+    res_u = torch.linalg.norm(weight @ Vh.T - U * S)
+    res_v = torch.linalg.norm(weight.T @ U - Vh.T * S)
+    return (torch.maximum(res_u, res_v) / s_norm).item()
+
+
+def resolve_svd_backend(shape, rank, backend):
+    """
+    Backend svd() will really use for a (out, in) weight and the wanted rank.
+    rank None: the rank is not known yet, 'auto' is resolved to 'full'
+    (a values pass before a full svd would only add cost).
+    """
+    assert backend in SVD_BACKENDS, f"unknown svd backend: {backend}"
+    min_dim = min(shape)
+    if rank is None:
+        return 'full' if backend == 'auto' else backend
+    if rank >= min_dim:
+        return 'full'
+    if backend == 'auto':
+        return 'randomized' if rank * 10 <= min_dim else 'full'
+    if backend == 'lanczos' and rank * 3 > min_dim:
+        return 'full'
+    return backend
+
+
+def svd(
+    weight: torch.Tensor,
+    rank: int = None,
+    backend = 'full',
+    oversample = 10,
+    niter = 4,
+    tol = 1e-2,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Top `rank` singular triplets (U, S, Vh) of a 2D weight, all if rank is None.
+    full: linalg.svd
+    randomized: torch.svd_lowrank with oversampling and power iterations
+    lanczos: top-k eigen pairs of the smaller gram matrix with lobpcg
+    auto: randomized if rank is small relative to the matrix size, else full
+    Approximated results are checked by svd_residual and fall back to full if > tol.
+    """
+    out_ch, in_ch = weight.shape
+    min_dim = min(out_ch, in_ch)
+    backend = resolve_svd_backend(weight.shape, rank, backend) if rank is not None else 'full'
     
-    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1).to(device))
+    if backend == 'randomized':
+        U, S, V = torch.svd_lowrank(weight, q=min(rank+oversample, min_dim), niter=niter)
+        U, S, Vh = U[:, :rank], S[:rank], V[:, :rank].T
+    elif backend == 'lanczos':
+        transpose = out_ch < in_ch
+        w = weight.T if transpose else weight
+        eigvals, V = torch.lobpcg(w.T @ w, k=rank, largest=True)
+        S, idx = torch.sort(eigvals.clamp_min(0).sqrt(), descending=True)
+        V = V[:, idx]
+        U = (w @ V) / S.clamp_min(1e-12)
+        if transpose:
+            U, V = V, U
+        Vh = V.T
+    else:
+        U, S, Vh = linalg.svd(weight, full_matrices=False)
+        if rank is not None:
+            U, S, Vh = U[:, :rank], S[:rank], Vh[:rank]
+        return U, S, Vh
     
+    if svd_residual(weight, U, S, Vh) > tol:
+        return svd(weight, rank, 'full')
+    return U, S, Vh
+
+
+def decide_rank(S, mode, mode_param, max_rank):
     if mode=='fixed':
         lora_rank = mode_param
     elif mode=='threshold':
@@ -31,13 +125,209 @@ def extract_conv(
         s_cum = torch.cumsum(S, dim=0)
         min_cum_sum = mode_param * torch.sum(S)
         lora_rank = torch.sum(s_cum<min_cum_sum)
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
+    lora_rank = max(1, int(lora_rank))
+    lora_rank = min(max_rank, lora_rank)
+    return lora_rank
+
+
+def reconstruction_stats(weight, S):
+    """
+    Error of a truncated svd from the kept singular values only:
+    |W - U S Vh|^2 = |W|^2 - sum(S^2)
+    """
+    norm2 = float(torch.linalg.vector_norm(weight, dtype=torch.float64) ** 2)
+    kept2 = min(float(torch.sum(S.double() ** 2)), norm2)
+    return {
+        'rank': len(S),
+        'norm2': norm2,
+        'kept2': kept2,
+        'energy': kept2 / norm2 if norm2 > 0 else 1.,
+        'rel_error': math.sqrt((norm2 - kept2) / norm2) if norm2 > 0 else 0.,
+    }
+
+
+def write_extract_report(stats, path=None):
+    """
+    stats: {lora_name: reconstruction_stats + 'params'}
+    Print summary totals, write per-layer stats to .json or .csv.
+    """
+    total_norm2 = sum(stat['norm2'] for stat in stats.values())
+    total_kept2 = sum(stat['kept2'] for stat in stats.values())
+    worst = max(stats, key=lambda name: stats[name]['rel_error'], default=None)
+    summary = {
+        'layers': len(stats),
+        'params': sum(stat['params'] for stat in stats.values()),
+        'energy': total_kept2 / total_norm2 if total_norm2 > 0 else 1.,
+        'rel_error': math.sqrt((total_norm2 - total_kept2) / total_norm2) if total_norm2 > 0 else 0.,
+        'mean_rel_error': sum(stat['rel_error'] for stat in stats.values()) / max(1, len(stats)),
+        'worst_layer': worst,
+        'worst_rel_error': stats[worst]['rel_error'] if worst is not None else 0.,
+    }
+    for key, value in summary.items():
+        print(f'{key}: {value}')
+    
+    if path is None:
+        return summary
+    if os.path.splitext(path)[1] == '.csv':
+        with open(path, 'w', newline='') as f:
+            fields = ['lora_name', 'rank', 'params', 'energy', 'rel_error', 'norm2', 'kept2']
+            writer = csv.DictWriter(f, fields, extrasaction='ignore')
+            writer.writeheader()
+            for lora_name, stat in stats.items():
+                writer.writerow({'lora_name': lora_name, **stat})
+    else:
+        with open(path, 'w') as f:
+            json.dump({'summary': summary, 'layers': stats}, f, indent=2)
+    return summary
+
+
+def factorize(
+    weight: torch.Tensor,
+    mode = 'fixed',
+    mode_param = 0,
+    max_rank = None,
+    svd_backend = 'auto',
+    cache: dict = None,
+    cache_rank = 0,
+    stats: dict = None,
+):
+    """
+    Decide the rank from singular values first, then compute only the needed vectors.
+    If the vectors would come from a full svd anyway ('full', or 'auto' without a known rank),
+    one reduced svd is run and sliced instead of a values pass + a full svd.
+    Return (lora_rank, U, S, Vh) of the 2D weight.
     
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
+    cache: {'S', 'U', 'Vh'} of this layer from SpectrumCache.layer.
+           Cached S is used to decide the rank and cached U/Vh are sliced if they have enough rank,
+           computed S and top cache_rank U/Vh are written back.
+    stats: filled with reconstruction_stats of the result.
+    """
+    max_rank = max_rank or min(weight.shape)
+    S = None
+    if cache is not None and 'S' in cache:
+        S = cache['S'].to(weight.device)
+    elif cache is not None or mode != 'fixed':
+        fixed_rank = decide_rank(None, mode, mode_param, max_rank) if mode == 'fixed' else None
+        if resolve_svd_backend(weight.shape, fixed_rank, svd_backend) == 'full':
+            # one reduced svd give both the spectrum to decide the rank and the vectors
+            U, S, Vh = linalg.svd(weight, full_matrices=False)
+            if cache is not None:
+                cache['S'] = S.cpu()
+                if cache_rank > 0:
+                    cache['U'] = U[:, :cache_rank].cpu()
+                    cache['Vh'] = Vh[:cache_rank].cpu()
+            lora_rank = decide_rank(S, mode, mode_param, max_rank)
+            if stats is not None:
+                stats.update(reconstruction_stats(weight, S[:lora_rank]))
+            return lora_rank, U[:, :lora_rank], S[:lora_rank], Vh[:lora_rank]
+        # a low rank backend follow: only the values first
+        S = linalg.svdvals(weight)
+        if cache is not None:
+            cache['S'] = S.cpu()
+    lora_rank = decide_rank(S, mode, mode_param, max_rank)
+    
+    if cache is not None and 'U' in cache and cache['U'].size(1) >= lora_rank:
+        U = cache['U'][:, :lora_rank].to(weight.device)
+        Vh = cache['Vh'][:lora_rank].to(weight.device)
+        if stats is not None:
+            stats.update(reconstruction_stats(weight, S[:lora_rank]))
+        return lora_rank, U, S[:lora_rank], Vh
+    
+    if cache is None or cache_rank <= lora_rank:
+        U, S, Vh = svd(weight, lora_rank, svd_backend)
+    else:
+        U, S, Vh = svd(weight, min(cache_rank, min(weight.shape)), svd_backend)
+    if cache is not None and cache_rank > 0:
+        cache['U'] = U[:, :cache_rank].cpu()
+        cache['Vh'] = Vh[:cache_rank].cpu()
+    if stats is not None:
+        stats.update(reconstruction_stats(weight, S[:lora_rank]))
+    return lora_rank, U[:, :lora_rank], S[:lora_rank], Vh[:lora_rank]
+
+
+class SpectrumCache:
+    """
+    Singular values (and optionally top max_rank U/Vh) of every layer diff,
+    so extraction with other mode/rank is only a slicing operation.
+    Stored in one .safetensors file, use spectrum_cache_path to key it by the checkpoint pair.
+    """
+    def __init__(self, path, max_rank=0):
+        self.path = path
+        self.max_rank = max_rank
+        self.layers = {}
+        if os.path.isfile(path):
+            for key, value in load_file(path).items():
+                lora_name, name = key.rsplit('.', 1)
+                self.layers.setdefault(lora_name, {})[name] = value
+            print(f'load spectrum cache: {path} ({len(self.layers)} layers)')
+
+    def layer(self, lora_name):
+        return self.layers.setdefault(lora_name, {})
+
+    def save(self):
+        save_file({
+            f'{lora_name}.{name}': value.contiguous()
+            for lora_name, layer in self.layers.items()
+            for name, value in layer.items()
+        }, self.path)
+
+
+def model_hash(path):
+    with open(path, 'rb') as f:
+        if os.path.splitext(path)[1] == '.safetensors':
+            # only hash the tensors, metadata changes don't matter
+            return addnet_hash_safetensors(f)
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+def model_pair_id(base_path, db_path):
+    return f'{model_hash(base_path)[:16]}_{model_hash(db_path)[:16]}'
+
+
+def spectrum_cache_path(cache_dir, base_path, db_path, pair_id=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    name = f'{pair_id or model_pair_id(base_path, db_path)}.safetensors'
+    return os.path.join(cache_dir, name)
+
+
+def split_singular_values(U, S, Vh, save_dtype=None):
+    """
+    Give sqrt(S) to both up (U) and down (Vh) by broadcasting,
+    so both factors have the same scale (better for fp16/bf16),
+    then cast to save_dtype on the compute device.
+    """
+    sqrt_s = S.sqrt()
+    U = U * sqrt_s
+    Vh = Vh * sqrt_s.unsqueeze(1)
+    if save_dtype is not None:
+        U = U.to(save_dtype)
+        Vh = Vh.to(save_dtype)
+    return U, Vh
+
+
+def extract_conv(
+    weight: nn.Parameter|torch.Tensor,
+    mode = 'fixed',
+    mode_param = 0,
+    device = 'cpu',
+    svd_backend = 'auto',
+    cache = None,
+    cache_rank = 0,
+    stats = None,
+    dtype = torch.float32,
+    save_dtype = None,
+) -> tuple[nn.Parameter, nn.Parameter]:
+    out_ch, in_ch, kernel_size, _ = weight.shape
+    weight = weight.reshape(out_ch, -1).to(device, dtype)
+    
+    lora_rank, U, S, Vh = factorize(
+        weight, mode, mode_param, min(out_ch, in_ch), 
+        svd_backend, cache, cache_rank, stats
+    )
+    U, Vh = split_singular_values(U, S, Vh, save_dtype)
     
     extract_weight_A = Vh.reshape(lora_rank, in_ch, kernel_size, kernel_size).cpu()
     extract_weight_B = U.reshape(out_ch, lora_rank, 1, 1).cpu()
@@ -67,37 +357,93 @@ def merge_conv(
     return weight
 
 
+def extract_tucker(
+    weight: nn.Parameter|torch.Tensor,
+    mode = 'fixed',
+    mode_param = 0,
+    device = 'cpu',
+    svd_backend = 'auto',
+    cache = None,
+    cache_rank = 0,
+    stats = None,
+    dtype = torch.float32,
+    save_dtype = None,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Tucker-2 (HOSVD) of a k x k conv weight on the out/in channel modes:
+    W[o, i, h, w] ~ up[o, r] * mid[r, s, h, w] * down[s, i]
+    The rank is decided on the out channel unfolding (same as extract_conv),
+    then the in channel projection is taken with the same rank.
+    Return (down (r, in, 1, 1), mid (r, r, k, k), up (out, r, 1, 1)) on cpu.
+    """
+    out_ch, in_ch, kernel_size, _ = weight.shape
+    weight = weight.to(device, dtype)
+    
+    lora_rank, U_out, _, _ = factorize(
+        weight.reshape(out_ch, -1), mode, mode_param, min(out_ch, in_ch), 
+        svd_backend, cache, cache_rank,
+    )
+    U_in, _, _ = svd(weight.transpose(0, 1).reshape(in_ch, -1), lora_rank, svd_backend)
+    U_in = U_in[:, :lora_rank]
+    core = torch.einsum('oihw,or,is->rshw', weight, U_out, U_in)
+    if stats is not None:
+        # U_out/U_in are orthonormal: |W - recon|^2 = |W|^2 - |core|^2
+        stats.update(reconstruction_stats(weight, core.flatten()))
+        stats['rank'] = lora_rank
+    
+    if save_dtype is not None:
+        U_out, core, U_in = U_out.to(save_dtype), core.to(save_dtype), U_in.to(save_dtype)
+    extract_weight_A = U_in.T.reshape(lora_rank, in_ch, 1, 1).cpu()
+    extract_weight_mid = core.contiguous().cpu()
+    extract_weight_B = U_out.reshape(out_ch, lora_rank, 1, 1).cpu()
+    del U_out, U_in, core, weight
+    return extract_weight_A, extract_weight_mid, extract_weight_B
+
+
+def merge_tucker(
+    weight_a: nn.Parameter|torch.Tensor,
+    weight_mid: nn.Parameter|torch.Tensor,
+    weight_b: nn.Parameter|torch.Tensor,
+    device = 'cpu'
+):
+    rank, in_ch, _, _ = weight_a.shape
+    out_ch, rank_, _, _ = weight_b.shape
+    assert rank == rank_ == weight_mid.size(0) == weight_mid.size(1)
+    
+    wa = weight_a.to(device).reshape(rank, in_ch)
+    wb = weight_b.to(device).reshape(out_ch, rank)
+    wm = weight_mid.to(device)
+    
+    if device == 'cpu':
+        wa = wa.float()
+        wb = wb.float()
+        wm = wm.float()
+    
+    weight = torch.einsum('ij...,oi,jk->ok...', wm, wb, wa)
+    del wa, wb, wm
+    return weight
+
+
 def extract_linear(
     weight: nn.Parameter|torch.Tensor,
     mode = 'fixed',
     mode_param = 0,
     device = 'cpu',
+    svd_backend = 'auto',
+    cache = None,
+    cache_rank = 0,
+    stats = None,
+    dtype = torch.float32,
+    save_dtype = None,
 ) -> tuple[nn.Parameter, nn.Parameter]:
     out_ch, in_ch = weight.shape
+    weight = weight.to(device, dtype)
     
-    U, S, Vh = linalg.svd(weight.to(device))
-    
-    if mode=='fixed':
-        lora_rank = mode_param
-    elif mode=='threshold':
-        assert mode_param>=0
-        lora_rank = torch.sum(S>mode_param)
-    elif mode=='ratio':
-        assert 1>=mode_param>=0
-        min_s = torch.max(S)*mode_param
-        lora_rank = torch.sum(S>min_s)
-    elif mode=='percentile':
-        assert 1>=mode_param>=0
-        s_cum = torch.cumsum(S, dim=0)
-        min_cum_sum = mode_param * torch.sum(S)
-        lora_rank = torch.sum(s_cum<min_cum_sum)
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
-    
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
+    lora_rank, U, S, Vh = factorize(
+        weight, mode, mode_param, min(out_ch, in_ch), 
+        svd_backend, cache, cache_rank, stats
+    )
+    U, Vh = split_singular_values(U, S, Vh, save_dtype)
     
     extract_weight_A = Vh.reshape(lora_rank, in_ch).cpu()
     extract_weight_B = U.reshape(out_ch, lora_rank).cpu()
@@ -105,6 +451,43 @@ def extract_linear(
     return extract_weight_A, extract_weight_B
 
 
+def extract_batched(
+    weights: list[torch.Tensor],
+    mode = 'fixed',
+    mode_param = 0,
+    device = 'cpu',
+    stats: list[dict] = None,
+    dtype = torch.float32,
+    save_dtype = None,
+) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    """
+    extract_linear/extract_conv for a list of same shaped weights
+    with one batched svd on the stacked weights.
+    stats: list of dict to fill with reconstruction_stats of every weight.
+    """
+    shape = weights[0].shape
+    out_ch, in_ch = shape[:2]
+    stacked = torch.stack([weight.reshape(out_ch, -1) for weight in weights]).to(device, dtype)
+    U, S, Vh = linalg.svd(stacked, full_matrices=False)
+    del stacked
+    
+    results = []
+    for i, (u, s, vh) in enumerate(zip(U, S, Vh)):
+        lora_rank = decide_rank(s, mode, mode_param, min(out_ch, in_ch))
+        if stats is not None:
+            stats[i].update(reconstruction_stats(weights[i], s[:lora_rank]))
+        u, vh = split_singular_values(u[:, :lora_rank], s[:lora_rank], vh[:lora_rank], save_dtype)
+        if len(shape) == 4:
+            extract_weight_A = vh.reshape(lora_rank, *shape[1:]).cpu()
+            extract_weight_B = u.reshape(out_ch, lora_rank, 1, 1).cpu()
+        else:
+            extract_weight_A = vh.cpu()
+            extract_weight_B = u.cpu()
+        results.append((extract_weight_A, extract_weight_B))
+    del U, S, Vh
+    return results
+
+
 def merge_linear(
     weight_a: nn.Parameter|torch.Tensor,
     weight_b: nn.Parameter|torch.Tensor,
@@ -126,136 +509,739 @@ def merge_linear(
     return weight
 
 
+def merge_loha(
+    w1a: torch.Tensor,
+    w1b: torch.Tensor,
+    w2a: torch.Tensor,
+    w2b: torch.Tensor,
+    device = 'cpu',
+    chunk_rows = 1024,
+):
+    """
+    (w1a @ w1b) * (w2a @ w2b), built chunk_rows output rows at a time,
+    so only the result and one chunk of the 2nd product are alive.
+    """
+    out_ch, rank = w1a.shape
+    assert w1b.size(0) == w2b.size(0) == w2a.size(1) == rank
+    
+    w1a = w1a.to(device).float()
+    w1b = w1b.to(device).float()
+    w2a = w2a.to(device).float()
+    w2b = w2b.to(device).float()
+    
+    weight = torch.empty(out_ch, w1b.size(1), device=device)
+    for i in range(0, out_ch, chunk_rows):
+        rows = weight[i:i+chunk_rows]
+        torch.mm(w1a[i:i+chunk_rows], w1b, out=rows)
+        rows.mul_(w2a[i:i+chunk_rows] @ w2b)
+    del w1a, w1b, w2a, w2b
+    return weight
+
+
+class PinnedBuffer:
+    """
+    Grow-only pinned cpu buffers (one per name), reused for every
+    cpu <-> device copy of merge_batched instead of pinning new memory each time.
+    """
+    def __init__(self):
+        self.buffers = {}
+    
+    def get(self, name, shape, dtype=torch.float32):
+        numel = math.prod(shape)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype:
+            self.buffers[name] = buffer = None
+            self.buffers[name] = buffer = torch.empty(numel, dtype=dtype, pin_memory=True)
+        return buffer[:numel].view(shape)
+
+
+def merge_batched(
+    weights_a: list[torch.Tensor],
+    weights_b: list[torch.Tensor],
+    scales: list[float] = None,
+    device = 'cpu',
+    to_cpu = True,
+    staging: PinnedBuffer = None,
+) -> torch.Tensor:
+    """
+    merge_linear/merge_conv for many layers with same shapes in one bmm.
+    Factors are stacked on cpu and moved to device once.
+    scales: per layer multiplier (e.g. alpha/rank * scale), applied on device.
+    to_cpu: bring the result (B, out, in*k*k) back to cpu in one transfer,
+            otherwise the result stays on device.
+    staging: pinned buffers for the stacked factors and the cpu result
+             (then the result is a view of it, use it before the next call).
+    """
+    on_cuda = torch.device(device).type == 'cuda'
+    factors = []
+    for name, weights in (('a', weights_a), ('b', weights_b)):
+        weights = [w.reshape(w.size(0), -1) for w in weights]
+        if on_cuda and staging is not None:
+            stacked = staging.get(name, (len(weights),) + tuple(weights[0].shape), weights[0].dtype)
+            torch.stack(weights, out=stacked)
+        else:
+            stacked = torch.stack(weights)
+        factors.append(stacked.to(device, torch.float32, non_blocking=True))
+    if on_cuda and staging is not None:
+        # the staging buffers are overwritten by the next call
+        torch.cuda.current_stream(device).synchronize()
+    wa, wb = factors
+    del factors
+    
+    merged = torch.bmm(wb, wa)
+    if scales is not None:
+        merged *= torch.tensor(scales, dtype=torch.float32, device=device).reshape(-1, 1, 1)
+    del wa, wb
+    if not to_cpu or not on_cuda:
+        return merged
+    
+    if staging is None:
+        result = torch.empty(merged.shape, dtype=merged.dtype, pin_memory=True)
+    else:
+        result = staging.get('result', merged.shape, merged.dtype)
+    result.copy_(merged, non_blocking=True)
+    torch.cuda.synchronize(device)
+    del merged
+    return result
+
+
+def shape_of(state_dict, key):
+    # LazyCheckpoint read the shape from the header without loading the tensor
+    if callable(getattr(state_dict, 'shape', None)):
+        return tuple(state_dict.shape(key))
+    return tuple(state_dict[key].shape)
+
+
+def batchable_shapes(state_dict, lora_name):
+    """
+    (lora_down shape, lora_up shape) if the module can be merged by merge_batched, else None.
+    """
+    if f'{lora_name}.lora_down.weight' not in state_dict:
+        return None
+    if f'{lora_name}.lora_mid.weight' in state_dict:
+        return None
+    return (
+        shape_of(state_dict, f'{lora_name}.lora_down.weight'),
+        shape_of(state_dict, f'{lora_name}.lora_up.weight'),
+    )
+
+
+def batch_size_of(shapes, max_batch_bytes):
+    """Number of layers with these factor shapes whose fp32 deltas fit in max_batch_bytes."""
+    down_shape, up_shape = shapes
+    delta_bytes = up_shape[0] * math.prod(down_shape[1:]) * 4
+    return max(1, max_batch_bytes // delta_bytes)
+
+
+def lora_alpha_scale(state_dict, lora_name, rank):
+    alpha = rank
+    if f'{lora_name}.alpha' in state_dict:
+        alpha = float(state_dict[f'{lora_name}.alpha'])
+    return alpha / rank
+
+
+SAFETENSORS_DTYPES = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+
+
+def read_safetensors_header(path):
+    """
+    {key: {'dtype', 'shape', 'data_offsets'}} (and '__metadata__') of a .safetensors file,
+    only the header is read.
+    """
+    with open(path, 'rb') as f:
+        header_size = int.from_bytes(f.read(8), 'little')
+        return json.loads(f.read(header_size))
+
+
+def save_file_streaming(path, tensor_infos, tensors, metadata=None):
+    """
+    Write a .safetensors file one tensor at a time.
+    tensor_infos: [(key, dtype, shape)] in writing order, used to build the header first.
+    tensors: iterable of (key, tensor) in the same order, every tensor is written
+             (and can be freed) before the next one is produced.
+    """
+    header = {}
+    if metadata:
+        header['__metadata__'] = metadata
+    offset = 0
+    for key, dtype, shape in tensor_infos:
+        size = math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+        header[key] = {
+            'dtype': SAFETENSORS_DTYPES[dtype],
+            'shape': list(shape),
+            'data_offsets': [offset, offset + size],
+        }
+        offset += size
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # pad with spaces so the data start at a multiple of 8
+    header += b' ' * (-len(header) % 8)
+    
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for (key, dtype, shape), (tensor_key, tensor) in zip(tensor_infos, tensors):
+            assert key == tensor_key and tensor.dtype == dtype and tuple(tensor.shape) == tuple(shape), \
+                f'{tensor_key} does not match the header'
+            data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+            f.write(memoryview(data.numpy()))
+            del tensor, data
+    os.replace(tmp_path, path)
+
+
+def save_shard(partial_dir, lora_name, lora, settings, stats=None):
+    path = os.path.join(partial_dir, f'{lora_name}.safetensors')
+    # write then rename, a crash never leave a broken shard
+    save_file(lora, path + '.tmp', settings | {'stats': json.dumps(stats)})
+    os.replace(path + '.tmp', path)
+
+
+def load_shard(partial_dir, lora_name, settings):
+    """
+    Return (lora, stats) of a finished layer, or None.
+    """
+    path = os.path.join(partial_dir, f'{lora_name}.safetensors')
+    if not os.path.isfile(path):
+        return None
+    with safe_open(path, framework='pt', device='cpu') as f:
+        metadata = f.metadata() or {}
+        if any(metadata.get(key) != value for key, value in settings.items()):
+            return None
+        lora = {key: f.get_tensor(key) for key in f.keys()}
+        return lora, json.loads(metadata.get('stats', 'null'))
+
+
+def consolidate_partial(partial_dir, output, lora_names=None, safetensors=True, remove=True):
+    """
+    Merge the shards in partial_dir into one file (.safetensors or torch.save).
+    lora_names: only these layers (in this order), all shards if None.
+    remove: delete the merged shards (and leftover .tmp files), then
+            partial_dir itself only if nothing else is left in it.
+    """
+    if lora_names is None:
+        lora_names = sorted(
+            file[:-len('.safetensors')] for file in os.listdir(partial_dir)
+            if file.endswith('.safetensors')
+        )
+    state_dict = {}
+    for lora_name in lora_names:
+        state_dict.update(load_file(os.path.join(partial_dir, f'{lora_name}.safetensors')))
+    if safetensors:
+        save_file(state_dict, output)
+    else:
+        torch.save(state_dict, output)
+    if remove:
+        for lora_name in lora_names:
+            for file in (f'{lora_name}.safetensors', f'{lora_name}.safetensors.tmp'):
+                path = os.path.join(partial_dir, file)
+                if os.path.isfile(path):
+                    os.remove(path)
+        if not os.listdir(partial_dir):
+            os.rmdir(partial_dir)
+    return state_dict
+
+
+def allocate_rank_budget(spectra, budget):
+    """
+    Choose the rank of every layer under a total parameter budget.
+    spectra: {lora_name: (S, rank_costs)}
+             rank_costs[r] is the number of parameters added by going from
+             rank r to r+1 (a number if it is the same for every rank).
+    Every layer get rank 1 first, then the singular values with the largest
+    energy gain (S^2) per stored parameter are taken until the budget is used up.
+    Return {lora_name: rank}
+    """
+    names = list(spectra)
+    spectra = {
+        name: (S.double(), torch.as_tensor(rank_costs, dtype=torch.double).expand(S.shape))
+        for name, (S, rank_costs) in spectra.items()
+    }
+    budget -= sum(float(rank_costs[0]) for _, rank_costs in spectra.values())
+    if budget < 0:
+        print('budget is smaller than rank 1 for every layer')
+    
+    gains, owners, costs = [], [], []
+    for idx, name in enumerate(names):
+        S, rank_costs = spectra[name]
+        S, rank_costs = S[1:], rank_costs[1:]
+        gains.append(S**2 / rank_costs)
+        owners.append(torch.full(S.shape, idx, dtype=torch.long))
+        costs.append(rank_costs)
+    gains = torch.cat(gains)
+    owners = torch.cat(owners)
+    costs = torch.cat(costs)
+    
+    order = torch.argsort(gains, descending=True)
+    taken = order[torch.cumsum(costs[order], dim=0) <= budget]
+    extra_ranks = torch.bincount(owners[taken], minlength=len(names))
+    return {name: 1 + int(extra) for name, extra in zip(names, extra_ranks)}
+
+
+def run_tasks(func, tasks, workers=1):
+    """
+    Yield func(task) for every task (in finish order),
+    in a thread pool if workers > 1. 
+    """
+    if workers <= 1:
+        for task in tqdm(tasks):
+            yield func(task)
+        return
+    num_threads = torch.get_num_threads()
+    with ThreadPoolExecutor(
+        workers,
+        initializer = torch.set_num_threads,
+        initargs = (max(1, num_threads // workers),)
+    ) as pool:
+        futures = [pool.submit(func, task) for task in tasks]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            yield future.result()
+    torch.set_num_threads(num_threads)
+
+
+def extract_jobs(
+    jobs,
+    mode = 'fixed',
+    linear_mode_param = 0,
+    conv_mode_param = 0,
+    extract_device = 'cpu',
+    svd_backend = 'auto',
+    workers = 1,
+    batch_svd = False,
+    max_batch = 16,
+    partial_dir = None,
+    spectrum_cache: SpectrumCache = None,
+    budget = None,
+    report = None,
+    dtype = torch.float32,
+    save_dtype = torch.float16,
+    fp64_max_numel = 0,
+    use_tucker = False,
+    source = None,
+):
+    """
+    Extract LoCon state dict from a list of (lora_name, shape, get_diff) jobs.
+    get_diff() return the diff weight, so only the running layers are in memory.
+    
+    workers > 1: run per-layer SVDs in a thread pool, largest layer first.
+    torch release the GIL in BLAS/LAPACK, so the cpu threads are split between workers.
+    batch_svd: layers with same shape are extracted with one batched full svd
+               (at most max_batch layers for each svd).
+    partial_dir: save every finished layer as a shard in it, layers which already
+                 have a shard (extracted with same settings) are skipped.
+                 Use consolidate_partial to merge the shards into one file.
+    source: id of the base/db pair (e.g. model_pair_id), shards of another pair are not reused.
+    spectrum_cache: reuse/record the singular values (and factors) of every layer.
+    report: write per-layer reconstruction error to this .json/.csv (see write_extract_report).
+    dtype: compute dtype of svd, layers with numel <= fp64_max_numel use float64.
+    save_dtype: dtype of lora_up/lora_down in the output.
+    use_tucker: extract k x k conv with extract_tucker (1x1 down, k x k mid, 1x1 up).
+    
+    mode 'budget': choose the rank of all layers together by allocate_rank_budget,
+                   budget is the total number of parameters of lora_up/lora_down
+                   (and lora_mid of tucker layers).
+    """
+    settings = {
+        'mode': str(mode),
+        'mode_param': str((linear_mode_param, conv_mode_param, budget)),
+        'save_dtype': str(save_dtype),
+        'use_tucker': str(use_tucker),
+        'dtype': str((dtype, fp64_max_numel)),
+        'source': str(source),
+    }
+    
+    def dtype_of(shape):
+        return torch.float64 if math.prod(shape) <= fp64_max_numel else dtype
+    
+    def is_tucker(shape):
+        return use_tucker and len(shape) == 4 and (shape[2] > 1 or shape[3] > 1)
+    
+    def max_rank_of(shape):
+        # extract_conv/extract_tucker clamp the rank to the channels, not in*k*k
+        return min(shape[0], shape[1])
+    
+    def params_of(shape, rank):
+        if is_tucker(shape):
+            # lora_mid is rank x rank x k x k
+            return rank * (shape[0] + shape[1]) + rank * rank * math.prod(shape[2:])
+        return rank * (shape[0] + math.prod(shape[1:]))
+    
+    def rank_costs(shape, num_ranks):
+        # params added by each of the first num_ranks rank steps,
+        # params_of(shape, r) - params_of(shape, r-1), grow with r for tucker
+        steps = torch.arange(1, num_ranks + 1, dtype=torch.double)
+        if is_tucker(shape):
+            return (shape[0] + shape[1]) + (2 * steps - 1) * math.prod(shape[2:])
+        return torch.full_like(steps, shape[0] + math.prod(shape[1:]))
+    
+    ranks = {}
+    if mode == 'budget':
+        assert budget is not None and budget > 0, 'budget mode need a positive budget'
+        
+        @torch.no_grad()
+        def get_spectrum(job):
+            lora_name, shape, get_diff = job
+            cache = None if spectrum_cache is None else spectrum_cache.layer(lora_name)
+            if cache is not None and 'S' in cache:
+                S = cache['S']
+            else:
+                diff = get_diff().reshape(shape[0], -1).to(extract_device, dtype_of(shape))
+                S = linalg.svdvals(diff).cpu()
+                if cache is not None:
+                    cache['S'] = S
+            S = S[:max_rank_of(shape)]
+            return lora_name, (S, rank_costs(shape, len(S)))
+        
+        print('compute singular values of all layers')
+        ranks = allocate_rank_budget(dict(run_tasks(get_spectrum, jobs, workers)), budget)
+        ranks = {n: min(ranks[n], max_rank_of(s)) for n, s, _ in jobs}
+        print(f'total params: {sum(params_of(s, ranks[n]) for n, s, _ in jobs)}')
+    
+    def mode_param_of(lora_name, shape):
+        if mode == 'budget':
+            return ranks[lora_name]
+        is_linear = len(shape) == 2 or (shape[2] == 1 and shape[3] == 1)
+        return linear_mode_param if is_linear else conv_mode_param
+    
+    extract_mode = 'fixed' if mode == 'budget' else mode
+    
+    def make_lora(lora_name, extract_a, extract_b, stats, extract_mid=None):
+        stats['params'] = extract_a.numel() + extract_b.numel()
+        lora = {
+            f'{lora_name}.lora_down.weight': extract_a.detach().contiguous(),
+            f'{lora_name}.lora_up.weight': extract_b.detach().contiguous(),
+            f'{lora_name}.alpha': torch.Tensor([extract_a.shape[0]]).half(),
+        }
+        if extract_mid is not None:
+            stats['params'] += extract_mid.numel()
+            lora[f'{lora_name}.lora_mid.weight'] = extract_mid.detach().contiguous()
+        return lora, stats
+    
+    @torch.no_grad()
+    def run_task(task):
+        stats = [{'params': 0} for _ in task]
+        if len(task) > 1:
+            extracted = extract_batched(
+                [get_diff() for _, _, get_diff in task],
+                extract_mode,
+                mode_param_of(*task[0][:2]),
+                device = extract_device,
+                stats = stats,
+                dtype = dtype_of(task[0][1]),
+                save_dtype = save_dtype,
+            )
+            return {
+                lora_name: make_lora(lora_name, extract_a, extract_b, stat)
+                for (lora_name, _, _), (extract_a, extract_b), stat in zip(task, extracted, stats)
+            }
+        
+        lora_name, shape, get_diff = task[0]
+        if is_tucker(shape):
+            extract = extract_tucker
+        elif len(shape) == 2:
+            extract = extract_linear
+        else:
+            extract = extract_conv
+        extracted = extract(
+            get_diff(),
+            extract_mode,
+            mode_param_of(lora_name, shape),
+            device = extract_device,
+            svd_backend = svd_backend,
+            cache = None if spectrum_cache is None else spectrum_cache.layer(lora_name),
+            cache_rank = 0 if spectrum_cache is None else spectrum_cache.max_rank,
+            stats = stats[0],
+            dtype = dtype_of(shape),
+            save_dtype = save_dtype,
+        )
+        if len(extracted) == 3:
+            extract_a, extract_mid, extract_b = extracted
+            return {lora_name: make_lora(lora_name, extract_a, extract_b, stats[0], extract_mid)}
+        extract_a, extract_b = extracted
+        return {lora_name: make_lora(lora_name, extract_a, extract_b, stats[0])}
+    
+    def make_tasks(jobs):
+        if not batch_svd or spectrum_cache is not None or mode == 'budget':
+            # cached layers only need slicing, budget mode has different rank for every layer
+            return [[job] for job in jobs]
+        groups = {}
+        for job in jobs:
+            # tucker layers are not batched, key them by name
+            key = job[0] if is_tucker(job[1]) else tuple(job[1])
+            groups.setdefault(key, []).append(job)
+        return [
+            group[i:i+max_batch]
+            for group in groups.values()
+            for i in range(0, len(group), max_batch)
+        ]
+    
+    results = {}
+    if partial_dir is not None:
+        os.makedirs(partial_dir, exist_ok=True)
+        for lora_name, _, _ in jobs:
+            shard = load_shard(partial_dir, lora_name, settings)
+            if shard is not None:
+                results[lora_name] = shard
+        if results:
+            print(f'resume from {partial_dir}: {len(results)} layers are done')
+    
+    def finish(task_results):
+        results.update(task_results)
+        if partial_dir is not None:
+            for lora_name, (lora, stats) in task_results.items():
+                save_shard(partial_dir, lora_name, lora, settings, stats)
+    
+    tasks = sorted(
+        make_tasks([job for job in jobs if job[0] not in results]), 
+        key=lambda task: sum(math.prod(shape) for _, shape, _ in task), 
+        reverse=True
+    )
+    for task_results in run_tasks(run_task, tasks, workers):
+        finish(task_results)
+    if spectrum_cache is not None:
+        spectrum_cache.save()
+    loras = {}
+    all_stats = {}
+    for lora_name, _, _ in jobs:
+        lora, stats = results[lora_name]
+        loras.update(lora)
+        if stats is not None:
+            all_stats[lora_name] = stats
+    write_extract_report(all_stats, report)
+    return loras
+
+
+class ModuleEntry(NamedTuple):
+    module: nn.Module
+    shape: tuple
+    kind: str
+
+
+_module_index_cache = WeakKeyDictionary()
+
+
+def get_module_index(
+    prefix,
+    root_module: nn.Module,
+    target_replace_modules,
+    rebuild = False,
+) -> dict[str, ModuleEntry]:
+    """
+    {lora_name: ModuleEntry} of every Linear/Conv2d inside the target modules.
+    Built with one named_modules() walk and cached per root module
+    (use rebuild=True if the module tree of root_module is changed).
+    """
+    targets = tuple(target_replace_modules)
+    cache = _module_index_cache.setdefault(root_module, {})
+    if not rebuild and (prefix, targets) in cache:
+        return cache[(prefix, targets)]
+    
+    target_names = set()
+    index = {}
+    for name, module in root_module.named_modules():
+        layer = module.__class__.__name__
+        if layer in targets:
+            target_names.add(name)
+        if layer not in {'Linear', 'Conv2d'}:
+            continue
+        # inside a target module if one of its parents is a target
+        parts = name.split('.')
+        if not any('.'.join(parts[:i]) in target_names for i in range(len(parts))):
+            continue
+        lora_name = (prefix + '.' + name).replace('.', '_')
+        index[lora_name] = ModuleEntry(module, tuple(module.weight.shape), layer)
+    
+    cache[(prefix, targets)] = index
+    return index
+
+
 def extract_diff(
     base_model,
     db_model,
     mode = 'fixed',
     linear_mode_param = 0,
     conv_mode_param = 0,
-    extract_device = 'cpu'
+    extract_device = 'cpu',
+    **kwargs,
 ):
-    UNET_TARGET_REPLACE_MODULE = [
-        "Transformer2DModel", 
-        "Attention", 
-        "ResnetBlock2D", 
-        "Downsample2D", 
-        "Upsample2D"
-    ]
-    TEXT_ENCODER_TARGET_REPLACE_MODULE = ["CLIPAttention", "CLIPMLP"]
-    LORA_PREFIX_UNET = 'lora_unet'
-    LORA_PREFIX_TEXT_ENCODER = 'lora_te'
-    def make_state_dict(
+    # other kwargs (svd_backend, workers, ...) are passed to extract_jobs
+    def make_jobs(
         prefix, 
         root_module: torch.nn.Module,
         target_module: torch.nn.Module,
         target_replace_modules
     ):
-        loras = {}
-        temp = {}
-        
-        for name, module in root_module.named_modules():
-            if module.__class__.__name__ in target_replace_modules:
-                temp[name] = {}
-                for child_name, child_module in module.named_modules():
-                    if child_module.__class__.__name__ not in {'Linear', 'Conv2d'}:
-                        continue
-                    temp[name][child_name] = child_module.weight
-        
-        for name, module in tqdm(list(target_module.named_modules())):
-            if name in temp:
-                weights = temp[name]
-                for child_name, child_module in module.named_modules():
-                    lora_name = prefix + '.' + name + '.' + child_name
-                    lora_name = lora_name.replace('.', '_')
-                    
-                    layer = child_module.__class__.__name__
-                    if layer == 'Linear':
-                        extract_a, extract_b = extract_linear(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param,
-                            device = extract_device,
-                        )
-                    elif layer == 'Conv2d':
-                        is_linear = (child_module.weight.shape[2] == 1
-                                     and child_module.weight.shape[3] == 1)
-                        extract_a, extract_b = extract_conv(
-                            (child_module.weight - weights[child_name]), 
-                            mode,
-                            linear_mode_param if is_linear else conv_mode_param,
-                            device = extract_device,
-                        )
-                    else:
-                        continue
-                    loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                    del extract_a, extract_b
-        return loras
+        base_index = get_module_index(prefix, root_module, target_replace_modules)
+        db_index = get_module_index(prefix, target_module, target_replace_modules)
+        jobs = []
+        for lora_name, entry in db_index.items():
+            if lora_name not in base_index:
+                continue
+            get_diff = partial(torch.sub, entry.module.weight, base_index[lora_name].module.weight)
+            jobs.append((lora_name, entry.shape, get_diff))
+        return jobs
     
-    text_encoder_loras = make_state_dict(
+    jobs = make_jobs(
         LORA_PREFIX_TEXT_ENCODER, 
         base_model[0], db_model[0], 
         TEXT_ENCODER_TARGET_REPLACE_MODULE
     )
-    
-    unet_loras = make_state_dict(
+    text_encoder_jobs = len(jobs)
+    jobs += make_jobs(
         LORA_PREFIX_UNET,
         base_model[2], db_model[2], 
         UNET_TARGET_REPLACE_MODULE
     )
-    print(len(text_encoder_loras), len(unet_loras))
-    return text_encoder_loras|unet_loras
+    print(text_encoder_jobs, len(jobs) - text_encoder_jobs)
+    return extract_jobs(
+        jobs, mode, 
+        linear_mode_param, conv_mode_param, 
+        extract_device, **kwargs
+    )
+
+
+def extract_diff_ldm(
+    base_path,
+    db_path,
+    v2 = False,
+    mode = 'fixed',
+    linear_mode_param = 0,
+    conv_mode_param = 0,
+    extract_device = 'cpu',
+    **kwargs,
+):
+    """
+    Same as extract_diff, but read weight pairs from the original SD checkpoints
+    one layer at a time instead of building two diffusers pipelines.
+    """
+    from .ldm_utils import LazyCheckpoint, make_lora_key_map, load_lora_weight
+    
+    base = LazyCheckpoint(base_path)
+    db = LazyCheckpoint(db_path)
+    key_map = make_lora_key_map(v2, base)
+    if kwargs.get('partial_dir') is not None and kwargs.get('source') is None:
+        kwargs['source'] = model_pair_id(base_path, db_path)
+    
+    def get_diff(entry):
+        return (
+            load_lora_weight(db, entry).float() 
+            - load_lora_weight(base, entry).float()
+        )
+    
+    jobs = [
+        (lora_name, entry[2], partial(get_diff, entry))
+        for lora_name, entry in key_map.items()
+        if entry[0] in db and db.shape(entry[0]) == base.shape(entry[0])
+    ]
+    print(f'{len(jobs)} layers to extract')
+    return extract_jobs(
+        jobs, mode, 
+        linear_mode_param, conv_mode_param, 
+        extract_device, **kwargs
+    )
+
+
+def lora_delta(
+    locon_state_dict: dict[str, torch.Tensor],
+    lora_name: str,
+    device = 'cpu',
+):
+    """
+    Delta weight (scaled by alpha/rank) of one LoCon or LoHa module
+    (LoHa conv delta is flattened to (out, in*k*k), reshape it to the layer shape),
+    or None if the state dict has no weight for it.
+    """
+    if f'{lora_name}.hada_w1_a' in locon_state_dict:
+        w1a, w1b, w2a, w2b = (
+            locon_state_dict[f'{lora_name}.{name}']
+            for name in ('hada_w1_a', 'hada_w1_b', 'hada_w2_a', 'hada_w2_b')
+        )
+        scale = lora_alpha_scale(locon_state_dict, lora_name, w1b.shape[0])
+        return merge_loha(w1a, w1b, w2a, w2b, device) * scale
+    
+    if f'{lora_name}.lora_down.weight' not in locon_state_dict:
+        return None
+    down = locon_state_dict[f'{lora_name}.lora_down.weight'].float()
+    up = locon_state_dict[f'{lora_name}.lora_up.weight'].float()
+    scale = lora_alpha_scale(locon_state_dict, lora_name, down.shape[0])
+    
+    if f'{lora_name}.lora_mid.weight' in locon_state_dict:
+        mid = locon_state_dict[f'{lora_name}.lora_mid.weight'].float()
+        delta = merge_tucker(down, mid, up, device)
+    elif down.dim() == 4:
+        delta = merge_conv(down, up, device)
+    else:
+        delta = merge_linear(down, up, device)
+    return delta * scale
 
 
 def merge_locon(
     base_model,
     locon_state_dict: dict[str, torch.TensorType],
     scale: float = 1.0,
-    device = 'cpu'
+    device = 'cpu',
+    max_batch_bytes = 512 * 1024**2,
 ):
-    UNET_TARGET_REPLACE_MODULE = [
-        "Transformer2DModel", 
-        "Attention", 
-        "ResnetBlock2D", 
-        "Downsample2D", 
-        "Upsample2D"
-    ]
-    TEXT_ENCODER_TARGET_REPLACE_MODULE = ["CLIPAttention", "CLIPMLP"]
-    LORA_PREFIX_UNET = 'lora_unet'
-    LORA_PREFIX_TEXT_ENCODER = 'lora_te'
+    """
+    Layers with same lora_down/lora_up shapes are merged together
+    by merge_batched (fp32 deltas of one batch are at most max_batch_bytes),
+    other layers (tucker, LoHa) are merged one by one.
+    """
+    staging = PinnedBuffer()
+
     def merge(
         prefix, 
         root_module: torch.nn.Module,
         target_replace_modules
     ):
-        temp = {}
+        index = get_module_index(prefix, root_module, target_replace_modules)
+        groups = {}
+        singles = []
+        for lora_name in index:
+            shapes = batchable_shapes(locon_state_dict, lora_name)
+            if shapes is not None:
+                groups.setdefault(shapes, []).append(lora_name)
+            elif (
+                f'{lora_name}.hada_w1_a' in locon_state_dict 
+                or f'{lora_name}.lora_down.weight' in locon_state_dict
+            ):
+                singles.append(lora_name)
+        batches = []
+        for shapes, group in groups.items():
+            size = batch_size_of(shapes, max_batch_bytes)
+            batches += [group[i:i+size] for i in range(0, len(group), size)]
         
-        for name, module in tqdm(list(root_module.named_modules())):
-            if module.__class__.__name__ in target_replace_modules:
-                temp[name] = {}
-                for child_name, child_module in module.named_modules():
-                    layer = child_module.__class__.__name__
-                    if layer not in {'Linear', 'Conv2d'}:
-                        continue
-                    lora_name = prefix + '.' + name + '.' + child_name
-                    lora_name = lora_name.replace('.', '_')
-                    
-                    down = locon_state_dict[f'{lora_name}.lora_down.weight'].float()
-                    up = locon_state_dict[f'{lora_name}.lora_up.weight'].float()
-                    alpha = locon_state_dict[f'{lora_name}.alpha'].float()
-                    rank = down.shape[0]
-                    
-                    if layer == 'Conv2d':
-                        delta = merge_conv(down, up, device)
-                        child_module.weight.requires_grad_(False)
-                        child_module.weight += (alpha.to(device)/rank * scale * delta).cpu()
-                        del delta
-                    elif layer == 'Linear':
-                        delta = merge_linear(down, up, device)
-                        child_module.weight.requires_grad_(False)
-                        child_module.weight += (alpha.to(device)/rank * scale * delta).cpu()
-                        del delta
+        def add_delta(lora_name, delta):
+            weight = index[lora_name].module.weight
+            weight.requires_grad_(False)
+            weight += delta.reshape(weight.shape).to(weight.dtype)
+        
+        for batch in tqdm(batches):
+            downs = [locon_state_dict[f'{lora_name}.lora_down.weight'] for lora_name in batch]
+            ups = [locon_state_dict[f'{lora_name}.lora_up.weight'] for lora_name in batch]
+            scales = [
+                lora_alpha_scale(locon_state_dict, lora_name, down.size(0)) * scale
+                for lora_name, down in zip(batch, downs)
+            ]
+            deltas = merge_batched(downs, ups, scales, device, staging=staging)
+            for lora_name, delta in zip(batch, deltas):
+                add_delta(lora_name, delta.cpu())
+            del deltas
+        
+        for lora_name in tqdm(singles):
+            delta = lora_delta(locon_state_dict, lora_name, device)
+            add_delta(lora_name, delta.mul_(scale).cpu())
+            del delta
     
     merge(
         LORA_PREFIX_TEXT_ENCODER, 
@@ -266,4 +1252,198 @@ def merge_locon(
         LORA_PREFIX_UNET,
         base_model[2], 
         UNET_TARGET_REPLACE_MODULE
-    )
\ No newline at end of file
+    )
+
+
+def lora_block_of(lora_name):
+    """
+    Block of a lora_name with the IN/MID/OUT numbering of the LDM UNet:
+    'TE', 'IN01'-'IN11', 'MID', 'OUT00'-'OUT11' (None if unknown).
+    """
+    if lora_name.startswith(LORA_PREFIX_TEXT_ENCODER):
+        return 'TE'
+    name = lora_name[len(LORA_PREFIX_UNET) + 1:]
+    if name.startswith('mid_block_'):
+        return 'MID'
+    parts = name.split('_')
+    if len(parts) < 4 or parts[0] not in {'down', 'up'} or not parts[2].isdigit():
+        return None
+    block, layer = int(parts[2]), parts[3]
+    index = int(parts[4]) if len(parts) > 4 and parts[4].isdigit() else 0
+    if parts[0] == 'down':
+        if layer == 'downsamplers':
+            return f'IN{3*block + 3:02d}'
+        return f'IN{3*block + index + 1:02d}'
+    if layer == 'upsamplers':
+        return f'OUT{3*block + 2:02d}'
+    return f'OUT{3*block + index:02d}'
+
+
+def parse_block_weights(spec):
+    """
+    'TE=1,IN=0.5,IN04=0.8,MID=0,OUT=1' -> {block: weight}
+    A group name (TE/IN/MID/OUT) set every block in it, exact block names override it.
+    """
+    if not spec:
+        return {}
+    block_weights = {}
+    for item in spec.split(','):
+        block, weight = item.split('=')
+        block_weights[block.strip().upper()] = float(weight)
+    return block_weights
+
+
+def block_weight_of(block_weights, lora_name):
+    block = lora_block_of(lora_name)
+    if block is None or not block_weights:
+        return 1.0
+    if block in block_weights:
+        return block_weights[block]
+    group = block.rstrip('0123456789')
+    return block_weights.get(group, 1.0)
+
+
+def merge_locon_ldm(
+    base_path,
+    locon_state_dict: dict[str, torch.Tensor],
+    output,
+    v2 = False,
+    scale: float = 1.0,
+    device = 'cpu',
+    save_dtype = None,
+    max_batch_bytes = 512 * 1024**2,
+    lookahead = 64,
+):
+    """
+    Merge one LoCon into the original SD checkpoint, see merge_loras_ldm.
+    """
+    merge_loras_ldm(
+        base_path, [(locon_state_dict, scale, None)], output,
+        v2, device, save_dtype, max_batch_bytes, lookahead
+    )
+
+
+def merge_loras_ldm(
+    base_path,
+    adapters,
+    output,
+    v2 = False,
+    device = 'cpu',
+    save_dtype = None,
+    max_batch_bytes = 512 * 1024**2,
+    lookahead = 64,
+):
+    """
+    Same as merge_locon + save_stable_diffusion_checkpoint, but work on the
+    original SD checkpoint: every lora_name is mapped to its LDM key once,
+    deltas are added to the raw tensors and the result is saved with the original keys.
+    No diffusers model is built.
+    
+    adapters: [(state_dict, weight, block_weights)], block_weights is the
+              output of parse_block_weights (or None).
+    All deltas of one weight are summed before it is updated.
+    LoCon deltas are built by merge_batched together with the following needed layers
+    of same factor shapes, looking at most `lookahead` layers ahead. Deltas built
+    for later layers wait on device until they are used, their batches take at most
+    max_batch_bytes in total, so peak memory is about one tensor + max_batch_bytes.
+    """
+    from .ldm_utils import LazyCheckpoint, make_lora_key_map
+    from .kohya_model_utils import is_safetensors
+    
+    base = LazyCheckpoint(base_path)
+    key_map = make_lora_key_map(v2, base)
+    
+    # ldm_key: [(chunk, lora_name, adapter)], fused qkv of SD2 text encoder get 3 deltas
+    targets = {}
+    for idx, (state_dict, _, _) in enumerate(adapters):
+        lora_names = {key.split('.', 1)[0] for key in state_dict.keys()}
+        matched = 0
+        for lora_name in sorted(lora_names):
+            if lora_name not in key_map:
+                continue
+            ldm_key, chunk, _ = key_map[lora_name]
+            targets.setdefault(ldm_key, []).append((chunk, lora_name, idx))
+            matched += 1
+        print(f'adapter {idx}: merge {matched} modules, {len(lora_names) - matched} modules are not found')
+    
+    def out_dtype(key):
+        dtype = base.dtype(key)
+        if save_dtype is not None and dtype.is_floating_point:
+            return save_dtype
+        return dtype
+    
+    def multiplier_of(idx, lora_name):
+        _, adapter_weight, block_weights = adapters[idx]
+        return adapter_weight * block_weight_of(block_weights, lora_name)
+    
+    # (adapter, lora_name) in the order merged_tensors need them
+    needed = [
+        (idx, lora_name)
+        for key in base.keys()
+        for _, lora_name, idx in targets.get(key, [])
+        if multiplier_of(idx, lora_name) != 0
+    ]
+    position = {item: i for i, item in enumerate(needed)}
+    shapes_of = {item: batchable_shapes(adapters[item[0]][0], item[1]) for item in needed}
+    # item: (delta, batch), batch = [views not used yet, bytes of the batch tensor]
+    # a batch tensor is freed only when all its views are used
+    pending = {}
+    pending_bytes = 0
+    staging = PinnedBuffer() if torch.device(device).type == 'cuda' else None
+    
+    def get_delta(idx, lora_name):
+        nonlocal pending_bytes
+        item = (idx, lora_name)
+        if item in pending:
+            delta, batch_info = pending.pop(item)
+            batch_info[0] -= 1
+            if batch_info[0] == 0:
+                pending_bytes -= batch_info[1]
+            return delta
+        shapes = shapes_of[item]
+        if shapes is None:
+            return lora_delta(adapters[idx][0], lora_name, device)
+        # fit the new batch in what is left of max_batch_bytes (at least this layer)
+        size = batch_size_of(shapes, max(0, max_batch_bytes - pending_bytes))
+        start = position[item]
+        batch = [
+            other for other in needed[start:start + lookahead]
+            if shapes_of[other] == shapes and other not in pending
+        ][:size]
+        downs = [adapters[i][0][f'{name}.lora_down.weight'] for i, name in batch]
+        ups = [adapters[i][0][f'{name}.lora_up.weight'] for i, name in batch]
+        scales = [
+            lora_alpha_scale(adapters[i][0], name, down.size(0))
+            for (i, name), down in zip(batch, downs)
+        ]
+        deltas = merge_batched(downs, ups, scales, device, to_cpu=False, staging=staging)
+        if len(batch) > 1:
+            batch_info = [len(batch) - 1, deltas.numel() * deltas.element_size()]
+            pending_bytes += batch_info[1]
+            for other, delta in zip(batch[1:], deltas[1:]):
+                pending[other] = (delta, batch_info)
+        return deltas[0]
+    
+    def merged_tensors():
+        for key in tqdm(list(base.keys())):
+            weight = base.get(key)
+            if key in targets:
+                delta_sum = torch.zeros(weight.shape, dtype=torch.float32, device=device)
+                for chunk, lora_name, idx in targets[key]:
+                    multiplier = multiplier_of(idx, lora_name)
+                    if multiplier == 0:
+                        continue
+                    delta = get_delta(idx, lora_name) * multiplier
+                    target = delta_sum if chunk is None else torch.chunk(delta_sum, 3)[chunk]
+                    target += delta.reshape(target.shape)
+                    del delta
+                weight = delta_sum.add_(weight.to(device, torch.float32))
+                del delta_sum
+            yield base.raw_keys[key], weight.to(out_dtype(key)).cpu()
+    
+    if is_safetensors(output):
+        # write tensor by tensor, peak memory is about one tensor
+        tensor_infos = [(base.raw_keys[key], out_dtype(key), base.shape(key)) for key in base.keys()]
+        save_file_streaming(output, tensor_infos, merged_tensors())
+    else:
+        torch.save({'state_dict': dict(merged_tensors())}, output)
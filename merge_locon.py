@@ -1,4 +1,62 @@
-from locon.utils import merge_locon
+import argparse
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "base_model", help="The model you want to merge the locon into",
+        default='', type=str
+    )
+    parser.add_argument(
+        "locon_model", help="the locon models you want to merge",
+        nargs='+', type=str
+    )
+    parser.add_argument(
+        "output_name", help="the output model",
+        default='./out.ckpt', type=str
+    )
+    parser.add_argument(
+        "--is_v2", help="Your base model is sd v2 or not",
+        default=False, action="store_true"
+    )
+    parser.add_argument(
+        "--device", help="Which device you want to use to merge the weight",
+        default='cpu', type=str
+    )
+    parser.add_argument(
+        "--weight", 
+        help=(
+            "weight of the locon model to merge. "
+            "Given once it is used for all models, otherwise repeat it once per model (in order)"
+        ),
+        default=None, action='append', type=float
+    )
+    parser.add_argument(
+        "--block_weight", 
+        help=(
+            'per block weight for each locon model, like "TE=1,IN=0.5,IN04=1,MID=0,OUT=1" '
+            '(blocks: TE, IN01-IN11, MID, OUT00-OUT11, a group name set all its blocks). '
+            'Given once it is used for all models, otherwise repeat it once per model (in order)'
+        ),
+        default=None, action='append', type=str
+    )
+    parser.add_argument(
+        "--dtype", help='dtype to save the merged model, can be "fp16", "bf16", "fp32"',
+        default='fp16', type=str
+    )
+    parser.add_argument(
+        "--diffusers", 
+        help=(
+            "load the base model into diffusers models, merge and convert it back "
+            "(old behaviour, slower and use more memory)"
+        ),
+        default=False, action="store_true"
+    )
+    return parser.parse_args()
+ARGS = get_args()
+
+
+from locon.utils import merge_locon, merge_locon_ldm, merge_loras_ldm, parse_block_weights
+from locon.ldm_utils import LazyCheckpoint
 from locon.kohya_model_utils import (
     load_models_from_stable_diffusion_checkpoint,
     save_stable_diffusion_checkpoint,
@@ -8,32 +66,75 @@ from locon.kohya_model_utils import (
 import torch
 
 
-BASE_MODEL = 'PATH_TO_BASE_MODEL'
-LOCON_MODEL = 'PATH_TO_LOCON_MODEL'
-OUTPUT_NAME = 'NAME_FOR_OUTPUT'
-SAFE_TENSOR = False
-WEIGHT = 1.0
-V2 = False
-DEVICE = 'cuda'
-DTYPE = torch.float16
+DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+    'fp32': torch.float32,
+}
 
 
-base = load_models_from_stable_diffusion_checkpoint(V2, BASE_MODEL)
-if SAFE_TENSOR:
-    locon = load_file(LOCON_MODEL)
-else:
-    locon = torch.load(LOCON_MODEL)
+def per_model(values, num_models, name):
+    if len(values) == 1:
+        return values * num_models
+    assert len(values) == num_models, f'need --{name} once or {num_models} times'
+    return values
+
+
+def main():
+    args = ARGS
+    dtype = DTYPES[args.dtype]
+    weights = per_model(args.weight or [1.0], len(args.locon_model), 'weight')
+    block_weights = per_model(args.block_weight or [None], len(args.locon_model), 'block_weight')
+    
+    if not args.diffusers and len(args.locon_model) == 1 and block_weights[0] is None:
+        merge_locon_ldm(
+            args.base_model,
+            LazyCheckpoint(args.locon_model[0]),
+            args.output_name,
+            args.is_v2,
+            weights[0],
+            args.device,
+            dtype,
+        )
+        return
+    
+    if not args.diffusers:
+        # adapters are read module by module when they are merged
+        adapters = [
+            (LazyCheckpoint(path), weight, parse_block_weights(block_weight))
+            for path, weight, block_weight in zip(args.locon_model, weights, block_weights)
+        ]
+        merge_loras_ldm(
+            args.base_model,
+            adapters,
+            args.output_name,
+            args.is_v2,
+            args.device,
+            dtype,
+        )
+        return
+    
+    assert len(args.locon_model) == 1 and block_weights[0] is None, \
+        '--diffusers only support one locon model without block weight'
+    if args.locon_model[0].endswith('.safetensors'):
+        locon = load_file(args.locon_model[0])
+    else:
+        locon = torch.load(args.locon_model[0], map_location='cpu')
+    
+    base = load_models_from_stable_diffusion_checkpoint(args.is_v2, args.base_model)
+    merge_locon(
+        base,
+        locon,
+        weights[0],
+        args.device
+    )
+    save_stable_diffusion_checkpoint(
+        args.is_v2, args.output_name, 
+        base[0], base[2], 
+        None, 0, 0, dtype, 
+        base[1]
+    )
 
-merge_locon(
-    base,
-    locon,
-    WEIGHT,
-    DEVICE
-)
 
-save_stable_diffusion_checkpoint(
-    V2, OUTPUT_NAME, 
-    base[0], base[2], 
-    None, 0, 0, DTYPE, 
-    base[1]
-)
\ No newline at end of file
+if __name__ == '__main__':
+    main()